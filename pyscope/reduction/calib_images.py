@@ -184,9 +184,11 @@ def calib_images_cli(
         logger.info(
             "--image-dir passed, ignoring fnames argument and using all images in directory."
         )
-        fnames = []
-        for ext in (".fts", ".fits", ".fit"):
-            fnames.extend(Path(image_dir).glob(f"*{ext}"))
+        fnames = [
+            path
+            for path in Path(image_dir).iterdir()
+            if path.suffix in (".fts", ".fits", ".fit")
+        ]
         logger.debug(f"fnames = {fnames}")
 
     logger.info(f"Calibrating {len(fnames)} images.")
@@ -239,9 +241,11 @@ def calib_images_cli(
         dark_frame = None
         bias_frame = None
         flat_dark_frame = None
-        calimages = []
-        for ext in (".fts", ".fits", ".fit"):
-            calimages.extend(Path(calib_dir).rglob(f"*{ext}"))
+        calimages = [
+            path
+            for path in Path(calib_dir).rglob("*")
+            if path.suffix in (".fts", ".fits", ".fit")
+        ]
 
         for calimg in calimages:
             # find flat_frame, dark_frame, bias_frame, flat_dark_frame
@@ -1,6 +1,12 @@
+import concurrent.futures
 import glob
+import json
 import logging
+import multiprocessing
 import os
+import queue
+import tempfile
+import threading
 import time
 from pathlib import Path
 
@@ -9,8 +15,24 @@ import click
 import numpy as np
 from astropy.io import fits
 
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 logger = logging.getLogger(__name__)
 
+_calib_state = {}
+_MISSING = object()
+_FITS_SUFFIXES = (".fts", ".fits", ".fit")
+_TILE_PIXELS = 2**16
+_SETUP_KEYS = ("readout_mode", "xbin", "ybin", "gain", "filter")
+
 
 @click.command(
     epilog="""Check out the documentation at
@@ -74,6 +96,21 @@ logger = logging.getLogger(__name__)
     show_default=True,
     help="Pedestal value to add to calibrated image.",
 )
+@click.option(
+    "--cache-masters",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Cache the master frames as float32 .npy files alongside the originals and reuse them on later runs.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of worker processes used to calibrate images in parallel. Ignored if --in-place is set.",
+)
 @click.option(
     "-v",
     "--verbose",
@@ -92,6 +129,8 @@ def ccd_calib_cli(
     astro_scrappy=(1, 3),
     bad_columns="",
     in_place=False,
+    cache_masters=False,
+    workers=1,
     verbose=0,
     pedestal=1000,
 ):
@@ -106,7 +145,8 @@ The calibration process supports additional features like hot pixel removal and
 Parameters
 ----------
 fnames : `list` of `str`
-    List of filenames to calibrate.
+    List of filenames to calibrate. Directories are expanded to the FITS files
+    (`.fts`, `.fits` or `.fit`) they contain.
 dark_frame : `str`, optional
     Path to master dark frame. If the camera type is `cmos`, the exposure time of the
     dark frame must match the exposure time of the target images.
@@ -126,6 +166,15 @@ bad_columns : `str`, optional
     in the adjacent column. Defaults to `""`.
 in_place : `bool`, optional
     If `True`, overwrites the input files with the calibrated images. Defaults to `False`.
+cache_masters : `bool`, optional
+    If `True`, the master frames are saved next to the originals as float32 ``.npy``
+    files with a ``.json`` file of their header attributes. These are reused on later
+    runs for as long as they are newer than the master frames. Defaults to `False`.
+workers : `int`, optional
+    Number of worker processes used to calibrate images in parallel. The workers
+    memory-map the master frames from temporary ``.npy`` files rather than each
+    holding a copy. Images are calibrated serially if `in_place` is `True`.
+    Defaults to `1`.
 pedestal : `int`, optional
     Pedestal value to add to calibrated images after processing to prevent negative
     pixel values. Defaults to `1000`.
@@ -156,413 +205,785 @@ Raises
 """
 
     if verbose == 2:
-        logging.basicConfig(level=logging.DEBUG)
+        level = logging.DEBUG
     elif verbose == 1:
-        logging.basicConfig(level=logging.INFO)
+        level = logging.INFO
     else:
-        logging.basicConfig(level=logging.WARNING)
+        level = logging.WARNING
+    logging.basicConfig(level=level)
 
     logger.debug(
-        f"""ccd_calib(\n\tcamera_type={camera_type}, \n\tdark_frame={dark_frame}, \n\tflat_frame={flat_frame}, \n\tbias_frame={bias_frame}, \n\tastro_scrappy={astro_scrappy}, \n\tbad_columns={bad_columns}, \n\tin_place={in_place}, \n\tfnames={fnames}, \n\tverbose={verbose}, \n\tpedestal={pedestal}\n)"""
+        """ccd_calib(\n\tcamera_type=%s, \n\tdark_frame=%s, \n\tflat_frame=%s, \n\tbias_frame=%s, \n\tastro_scrappy=%s, \n\tbad_columns=%s, \n\tin_place=%s, \n\tcache_masters=%s, \n\tworkers=%s, \n\tfnames=%s, \n\tverbose=%s, \n\tpedestal=%s\n)""",
+        camera_type,
+        dark_frame,
+        flat_frame,
+        bias_frame,
+        astro_scrappy,
+        bad_columns,
+        in_place,
+        cache_masters,
+        workers,
+        fnames,
+        verbose,
+        pedestal,
+    )
+
+    if isinstance(fnames, (str, os.PathLike)):
+        fnames = [fnames]
+    # Each directory is listed once and filtered by suffix rather than being
+    # globbed separately for every FITS extension
+    image_fnames = []
+    for fname in fnames:
+        if os.path.isdir(fname):
+            image_fnames.extend(
+                sorted(
+                    str(path)
+                    for path in Path(fname).iterdir()
+                    if path.suffix.lower() in _FITS_SUFFIXES
+                )
+            )
+        else:
+            image_fnames.append(fname)
+    fnames = image_fnames
+
+    bad_cols = np.array(
+        [int(col) for col in bad_columns.split(",") if col.strip()], dtype=np.intp
     )
 
     logger.info("Loading calibration frames...")
 
+    bias = dark = flat = None
+    bias_info = dark_info = flat_info = None
+
     camera_type = camera_type.lower()
     if camera_type == "ccd":
         if bias_frame is not None:
-            logger.info(f"Loading bias frame: {bias_frame}")
-            bias, bias_hdr = fits.getdata(bias_frame).astype(
-                np.float64
-            ), fits.getheader(bias_frame)
+            logger.info("Loading bias frame: %s", bias_frame)
+            bias, bias_info = _load_master(bias_frame, cache=cache_masters)
 
-            try:
-                bias_frametyp = bias_hdr["IMAGETYP"]
-            except KeyError:
-                bias_frametyp = ""
-            if "bias" not in bias_frametyp.lower():
+            if "bias" not in bias_info["frametyp"].lower():
                 logger.warning(
-                    f"Bias frame frametype ({bias_frametyp}) does not match 'bias'"
+                    "Bias frame frametype (%s) does not match 'bias'",
+                    bias_info["frametyp"],
                 )
 
-            try:
-                bias_readout_mode = bias_hdr["READOUTM"]
-            except KeyError:
-                bias_readout_mode = bias_hdr["READOUT"]
-
-            try:
-                bias_exptime = round(bias_hdr["EXPTIME"], 3)
-            except KeyError:
-                bias_exptime = round(bias_hdr["EXPOSURE"], 3)
-
-            try:
-                bias_xbin = bias_hdr["XBINNING"]
-            except:
-                bias_xbin = bias_hdr["XBIN"]
+            for key, value in bias_info.items():
+                logger.debug("Bias frame %s: %s", key, value)
 
-            try:
-                bias_ybin = bias_hdr["YBINNING"]
-            except:
-                bias_ybin = bias_hdr["YBIN"]
+    if dark_frame is not None:
+        logger.info("Loading dark frame: %s", dark_frame)
+        dark, dark_info = _load_master(dark_frame, cache=cache_masters)
 
-            try:
-                bias_gain = bias_hdr["GAIN"]
-            except:
-                bias_gain = ""
+        if "dark" not in dark_info["frametyp"].lower():
+            logger.warning(
+                "Dark frame frametype (%s) does not match 'dark'", dark_info["frametyp"]
+            )
 
-            logger.debug(f"Bias frame frametype: {bias_frametyp}")
-            logger.debug(f"Bias frame readout mode: {bias_readout_mode}")
-            logger.debug(f"Bias gain: {bias_gain}")
-            logger.debug(f"Bias frame exposure time: {bias_exptime}")
-            logger.debug(f"Bias frame X binning: {bias_xbin}")
-            logger.debug(f"Bias frame Y binning: {bias_ybin}")
+        for key, value in dark_info.items():
+            logger.debug("Dark frame %s: %s", key, value)
 
-    if dark_frame is not None:
-        logger.info(f"Loading dark frame: {dark_frame}")
-        dark, dark_hdr = fits.getdata(dark_frame).astype(np.float64), fits.getheader(
-            dark_frame
-        )
+    if flat_frame is not None:
+        logger.info("Loading flat frame: %s", flat_frame)
+        flat, flat_info = _load_master(flat_frame, cache=cache_masters)
 
-        try:
-            dark_frametyp = dark_hdr["IMAGETYP"]
-        except KeyError:
-            dark_frametyp = ""
-        if "dark" not in dark_frametyp.lower():
+        flat_frametyp = flat_info["frametyp"].lower()
+        if "flat" not in flat_frametyp and "light" not in flat_frametyp:
             logger.warning(
-                f"Dark frame frametype ({dark_frametyp}) does not match 'dark'"
+                "Flat frame frametype (%s) does not match 'flat'", flat_info["frametyp"]
             )
 
-        try:
-            dark_readout_mode = dark_hdr["READOUTM"]
-        except KeyError:
-            dark_readout_mode = dark_hdr["READOUT"]
+        for key, value in flat_info.items():
+            logger.debug("Flat frame %s: %s", key, value)
 
-        try:
-            dark_exptime = round(dark_hdr["EXPTIME"], 3)
-        except KeyError:
-            dark_exptime = round(dark_hdr["EXPOSURE"], 3)
+    # The bias-subtracted dark only depends on the master frames, so it is
+    # computed once here and scaled to the exposure time of each image
+    dark_minus_bias = None
+    if dark_frame is not None:
+        if camera_type == "ccd" and bias_frame is not None:
+            dark_minus_bias = np.subtract(dark, bias)
+        else:
+            dark_minus_bias = dark
 
-        try:
-            dark_xbin = dark_hdr["XBINNING"]
-        except:
-            dark_xbin = dark_hdr["XBIN"]
+    # The flat is the same for every image, so it is normalized only once
+    if flat_frame is not None:
+        logger.info("Checking if flat frame has a pedestal...")
+        flat_pedestal = flat_info["pedestal"]
+        if flat_pedestal:
+            logger.info("Pedestal keyword found, value: %s", flat_pedestal)
+            logger.info("Subtracting pedestal of %s from flat frame.", flat_pedestal)
+
+        logger.info("Normalizing the flat frame by the mean of the entire image.")
+        # The mean of the pedestal-subtracted flat is the mean of the raw flat
+        # minus the pedestal, so the mean is taken from the raw flat and the
+        # subtraction is done on the buffer that is then normalized in place.
+        # The sum is accumulated in double precision to avoid losing precision
+        # when summing many single-precision pixels.
+        flat_mean = float(np.mean(flat, dtype=np.float64)) - flat_pedestal
+        logger.info("flat_mean: %s", flat_mean)
+        normalized_flat = np.subtract(flat, flat_pedestal)
+        flat = np.divide(normalized_flat, flat_mean, out=normalized_flat)
+
+    state = dict(
+        camera_type=camera_type,
+        bias_frame=bias_frame,
+        dark_frame=dark_frame,
+        flat_frame=flat_frame,
+        bias=bias,
+        dark_minus_bias=dark_minus_bias,
+        flat=flat,
+        bias_info=bias_info,
+        dark_info=dark_info,
+        flat_info=flat_info,
+        astro_scrappy=astro_scrappy,
+        bad_columns=bad_columns,
+        bad_cols=bad_cols,
+        in_place=in_place,
+        pedestal=pedestal,
+        level=level,
+    )
 
+    groups = _group_by_setup(fnames)
+
+    # The state is cleared when done so that the masters and working image
+    # are not kept in memory after calibrating
+    try:
+        _init_calib_state(state)
+
+        # The masters are the same for every image, so the headers are checked
+        # once for each setup here rather than by every worker
+        for info, _ in groups:
+            if info is not None:
+                _check_frame_info(info)
+
+        items = [item for _, group in groups for item in group]
+        fnames = [fname for fname, _ in items]
+        hdrs = [hdr for _, hdr in items]
+        logger.debug("Calibrating %s image(s): %s", len(fnames), fnames)
+
+        workers = min(workers, len(fnames))
+
+        # Each image is independent, so batches are spread over worker processes.
+        # Overwriting files in place is kept serial.
+        if in_place or workers <= 1:
+            # Images are written by a separate thread while the next one is being
+            # calibrated. The queue is bounded so only a couple of calibrated images
+            # wait in memory when writing is slower than calibrating.
+            write_queue = queue.Queue(maxsize=2)
+            write_errors = []
+            writer = threading.Thread(
+                target=_write_worker, args=(write_queue, write_errors), daemon=True
+            )
+            writer.start()
+            try:
+                for fname, hdr in zip(fnames, hdrs):
+                    # Once an image fails to be written, the rest are not
+                    # calibrated only to be dropped
+                    if write_errors:
+                        break
+                    _calibrate_one(fname, hdr, write_queue=write_queue)
+            finally:
+                write_queue.put(None)
+                writer.join()
+            if write_errors:
+                raise write_errors[0]
+        else:
+            logger.info("Calibrating images using %s worker processes", workers)
+            if numba is not None:
+                # Share the CPUs between the workers rather than every worker
+                # starting a thread for each CPU
+                state["threads"] = max(1, numba.config.NUMBA_NUM_THREADS // workers)
+            # The master frames are handed to the workers as .npy files that they
+            # memory-map, so that they share the pages instead of each one
+            # receiving a pickled copy. The workers are spawned rather than forked
+            # since forking a process that has started numba or writer threads can
+            # deadlock.
+            with tempfile.TemporaryDirectory() as tmpdir:
+                pool_state = dict(state)
+                for key in ("bias", "dark_minus_bias", "flat"):
+                    pool_state[key] = _npy_path(state[key], os.path.join(tmpdir, key))
+                with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_calib_state,
+                    initargs=(pool_state,),
+                ) as executor:
+                    for _ in executor.map(_calibrate_one, fnames, hdrs):
+                        pass
+
+    finally:
+        _calib_state.clear()
+
+
+def _group_by_setup(fnames):
+    """Orders images so that those taken with the same setup are consecutive.
+
+    Only the headers are read. Images are grouped by exposure time, readout
+    mode, binning, gain and filter, keeping the order in which each group first
+    appears, so that the header checks and the scaled dark are only computed
+    once for each group. A list of `(info, items)` tuples is returned, where
+    ``info`` holds the header attributes of the group and ``items`` are
+    `(fname, header)` tuples, so that the headers are not parsed again when the
+    images are calibrated. Images whose headers cannot be parsed are kept
+    together at the end, with an ``info`` of `None`, and reported when they
+    are calibrated.
+    """
+    groups = {}
+    for fname in fnames:
+        hdr = None
         try:
-            dark_ybin = dark_hdr["YBINNING"]
-        except:
-            dark_ybin = dark_hdr["YBIN"]
+            hdr = _read_header(fname)
+            info = _frame_info(hdr)
+            key = tuple(info[k] for k in ("exptime",) + _SETUP_KEYS)
+        except (KeyError, OSError):
+            info = key = None
+        groups.setdefault(key, (info, []))[1].append((fname, hdr))
+
+    unparsed = groups.pop(None, None)
+    logger.debug("Found %s image setup(s)", len(groups))
+    return list(groups.values()) + ([unparsed] if unparsed is not None else [])
+
+
+def _read_header(path):
+    """Reads the header of the first HDU with data in a FITS file."""
+    with fits.open(path) as hdul:
+        hdu = hdul[0] if hdul[0].header.get("NAXIS", 0) > 0 else hdul[1]
+        return hdu.header
+
+
+def _read_fits(path, out=None, hdr=None):
+    """Reads the float32 data and header of the first HDU with data in a FITS file.
+
+    `fitsio` is used instead of `astropy.io.fits` when it is installed since its
+    CFITSIO bindings are faster at reading many small files. The header is then a
+    `fitsio.FITSHDR`, which supports the same lookups as `astropy.io.fits.Header`.
+    Otherwise the data is converted to float32 while the file is still open, so
+    that it is copied only once from the pages astropy memory-maps.
+
+    If ``out`` is a float32 array with the same shape as the data, the data is
+    converted into it instead of a newly allocated array. If the header has
+    already been read, it can be passed as ``hdr`` so that only the data is read
+    and ``hdr`` is returned as is.
+    """
+    if fitsio is not None:
+        if hdr is not None:
+            return _as_float32(fitsio.read(path, header=False), out), hdr
+        data, hdr = fitsio.read(path, header=True)
+        return _as_float32(data, out), hdr
 
-        try:
-            dark_gain = dark_hdr["GAIN"]
-        except:
-            dark_gain = ""
+    # memmap is left to its default since astropy refuses to memory-map data
+    # with BZERO/BSCALE, which is how 16-bit camera images are stored
+    with fits.open(path) as hdul:
+        hdu = hdul[0] if hdul[0].data is not None else hdul[1]
+        return _as_float32(hdu.data, out), hdu.header if hdr is None else hdr
 
-        logger.debug(f"Dark frame frametype: {dark_frametyp}")
-        logger.debug(f"Dark frame readout mode: {dark_readout_mode}")
-        logger.debug(f"Dark gain: {dark_gain}")
-        logger.debug(f"Dark frame exposure time: {dark_exptime}")
-        logger.debug(f"Dark frame X binning: {dark_xbin}")
-        logger.debug(f"Dark frame Y binning: {dark_ybin}")
 
-    if flat_frame is not None:
-        logger.info(f"Loading flat frame: {flat_frame}")
-        flat, flat_hdr = fits.getdata(flat_frame).astype(np.float64), fits.getheader(
-            flat_frame
-        )
+def _as_float32(data, out=None):
+    """Converts data to float32, reusing ``out`` if it has the right shape."""
+    if out is None or out.shape != data.shape:
+        return np.array(data, dtype=np.float32)
+    np.copyto(out, data, casting="unsafe")
+    return out
 
-        try:
-            flat_frametyp = flat_hdr["IMAGETYP"]
-        except KeyError:
-            flat_frametyp = ""
-        if "flat" not in flat_frametyp.lower() and "light" not in flat_frametyp.lower():
-            logger.warning(
-                f"Flat frame frametype ({flat_frametyp}) does not match 'flat'"
-            )
 
-        try:
-            flat_filter = flat_hdr["FILTER"]
-        except KeyError:
-            flat_filter = ""
+def _hget(hdr, *keys, default=_MISSING):
+    """Returns the value of the first of ``keys`` present in a header.
 
-        try:
-            flat_readout_mode = flat_hdr["READOUTM"]
-        except KeyError:
-            flat_readout_mode = flat_hdr["READOUT"]
+    Checking membership first avoids raising and catching a `KeyError` for
+    every optional keyword. If none of ``keys`` are present, ``default`` is
+    returned, or a `KeyError` is raised if no default is given.
+    """
+    for key in keys:
+        if key in hdr:
+            return hdr[key]
+    if default is _MISSING:
+        raise KeyError(f"None of the keywords {keys} are in the header")
+    return default
+
+
+def _frame_info(hdr):
+    """Extracts the header attributes used to match images to master frames."""
+    return dict(
+        frametyp=_hget(hdr, "IMAGETYP", default=""),
+        readout_mode=_hget(hdr, "READOUTM", "READOUT"),
+        exptime=round(_hget(hdr, "EXPTIME", "EXPOSURE"), 3),
+        xbin=_hget(hdr, "XBINNING", "XBIN"),
+        ybin=_hget(hdr, "YBINNING", "YBIN"),
+        gain=_hget(hdr, "GAIN", default=""),
+        filter=_hget(hdr, "FILTER", default=""),
+        pedestal=_hget(hdr, "PEDESTAL", default=0),
+    )
 
-        try:
-            flat_exptime = round(flat_hdr["EXPTIME"], 3)
-        except KeyError:
-            flat_exptime = round(flat_hdr["EXPOSURE"], 3)
 
-        try:
-            flat_xbin = flat_hdr["XBINNING"]
-        except:
-            flat_xbin = flat_hdr["XBIN"]
+def _load_master(path, cache=False):
+    """Loads a master calibration frame as float32 along with its header attributes.
 
+    If ``cache`` is `True`, the data and header attributes are also saved next to
+    the frame as ``.f32.npy`` and ``.json`` files. These are memory-mapped and
+    reused by later calls for as long as they are newer than the frame itself.
+    """
+    root = os.path.splitext(path)[0]
+    npy_path = root + ".f32.npy"
+    json_path = root + ".json"
+
+    if cache and all(
+        os.path.exists(p) and os.path.getmtime(p) >= os.path.getmtime(path)
+        for p in (npy_path, json_path)
+    ):
+        logger.info("Using cached master frame: %s", npy_path)
+        with open(json_path, "r") as f:
+            info = json.load(f)
+        return np.load(npy_path, mmap_mode="r"), info
+
+    data, hdr = _read_fits(path)
+    info = _frame_info(hdr)
+
+    if cache:
         try:
-            flat_ybin = flat_hdr["YBINNING"]
-        except:
-            flat_ybin = flat_hdr["YBIN"]
+            np.save(npy_path, data)
+            with open(json_path, "w") as f:
+                json.dump(info, f)
+            logger.info("Cached master frame to %s", npy_path)
+        except OSError as e:
+            logger.warning("Unable to cache master frame %s: %s", path, e)
 
-        try:
-            flat_gain = flat_hdr["GAIN"]
-        except:
-            flat_gain = ""
+    return data, info
 
-        try:
-            flat_pedestal = flat_hdr["PEDESTAL"]
-        except:
-            flat_pedestal = 0
 
-        logger.debug(f"Flat frame frametype: {flat_frametyp}")
-        logger.debug(f"Flat frame readout mode: {flat_readout_mode}")
-        logger.debug(f"Flat gain: {flat_gain}")
-        logger.debug(f"Flat frame exposure time: {flat_exptime}")
-        logger.debug(f"Flat frame X binning: {flat_xbin}")
-        logger.debug(f"Flat frame Y binning: {flat_ybin}")
-        logger.debug(f"Flat pedestal: {flat_pedestal}")
+def _npy_path(frame, root):
+    """Returns the path of a ``.npy`` file holding a master frame.
 
-    logger.debug(f"Calibrating {len(fnames)} image(s): {fnames}")
+    Frames that are already memory-mapped from a ``.npy`` file, such as those
+    cached by `_load_master`, are not saved again.
+    """
+    if frame is None:
+        return None
+    if isinstance(frame, np.memmap) and str(frame.filename).endswith(".npy"):
+        return frame.filename
+    np.save(root + ".npy", frame)
+    return root + ".npy"
 
-    for fname in fnames:
-        logger.info(f"Calibrating {fname}...")
-        image, hdr = fits.getdata(fname).astype(np.float64), fits.getheader(fname)
 
-        if "CALSTAT" in hdr.keys():
-            if hdr["CALSTAT"]:
-                logger.warning("Image already calibrated. Skipping...")
-                continue
+def _init_calib_state(state):
+    """Stores the master frames and options shared by every image in a batch.
 
-        try:
-            image_frametyp = hdr["IMAGETYP"]
-        except KeyError:
-            image_frametyp = ""
-        if (
-            "light" not in image_frametyp.lower()
-            and "flat" not in image.frametyp.lower()
-        ):
-            logger.warning(
-                f"Image frametype ({image_frametyp}) does not match 'light' or 'flat'"
-            )
+    Used as the initializer of the worker processes, which memory-map master
+    frames passed as paths to ``.npy`` files. Logging is configured again since
+    spawned workers do not inherit the configuration of the parent.
+    """
+    logging.basicConfig(level=state.get("level", logging.WARNING))
 
-        try:
-            image_filter = hdr["FILTER"]
-        except KeyError:
-            image_filter = ""
+    _calib_state.clear()
+    _calib_state.update(state)
+    _calib_state["scaled_darks"] = {}
+    for key in ("bias", "dark_minus_bias", "flat"):
+        if isinstance(state.get(key), (str, os.PathLike)):
+            _calib_state[key] = np.load(state[key], mmap_mode="r")
 
-        try:
-            image_readout_mode = hdr["READOUTM"]
-        except KeyError:
-            image_readout_mode = hdr["READOUT"]
+    if numba is not None and state.get("threads") is not None:
+        numba.set_num_threads(state["threads"])
 
-        try:
-            image_exptime = round(hdr["EXPTIME"], 3)
-        except KeyError:
-            image_exptime = round(hdr["EXPOSURE"], 3)
 
-        try:
-            image_xbin = hdr["XBINNING"]
-        except:
-            image_xbin = hdr["XBIN"]
+def _calibrate_one(fname, hdr=None, write_queue=None):
+    """Calibrates a single image using the frames stored by `_init_calib_state`.
 
-        try:
-            image_ybin = hdr["YBINNING"]
-        except:
-            image_ybin = hdr["YBIN"]
+    ``hdr`` is the `astropy.io.fits.Header` of the image if it has already been
+    read, in which case only the data is read from the file. The calibrated
+    image is written directly, or put on `write_queue` as a
+    `(fname, image, header)` tuple to be written by `_write_worker`.
+    """
+    camera_type = _calib_state["camera_type"]
+    bias_frame = _calib_state["bias_frame"]
+    dark_frame = _calib_state["dark_frame"]
+    flat_frame = _calib_state["flat_frame"]
+    bias = _calib_state["bias"]
+    dark_minus_bias = _calib_state["dark_minus_bias"]
+    flat = _calib_state["flat"]
+    dark_info = _calib_state["dark_info"]
+    astro_scrappy = _calib_state["astro_scrappy"]
+    bad_columns = _calib_state["bad_columns"]
+    bad_cols = _calib_state["bad_cols"]
+    in_place = _calib_state["in_place"]
+    pedestal = _calib_state["pedestal"]
+    scaled_darks = _calib_state["scaled_darks"]
+    scaled_dark = dark_minus_bias
+
+    logger.info("Calibrating %s...", fname)
+    # The header is written back out along with the calibrated image, so it
+    # has to be an astropy header rather than the one read by fitsio
+    if hdr is None:
+        hdr = _read_header(fname)
+
+    if _hget(hdr, "CALSTAT", default=False):
+        logger.warning("Image already calibrated. Skipping...")
+        return
+
+    # The float32 buffer of the previous image is reused when it is free
+    image, hdr = _read_fits(fname, out=_calib_state.get("work"), hdr=hdr)
+    _calib_state["work"] = image
+
+    image_info = _frame_info(hdr)
+    image_frametyp = image_info["frametyp"].lower()
+    if "light" not in image_frametyp and "flat" not in image_frametyp:
+        logger.warning(
+            "Image frametype (%s) does not match 'light' or 'flat'",
+            image_info["frametyp"],
+        )
 
-        try:
-            image_gain = hdr["GAIN"]
-        except:
-            image_gain = ""
+    logger.debug("Image readout mode: %s", image_info["readout_mode"])
+    logger.debug("Image gain: %s", image_info["gain"])
+    logger.debug("Image exposure time: %s", image_info["exptime"])
+    logger.debug("Image X binning: %s", image_info["xbin"])
+    logger.debug("Image Y binning: %s", image_info["ybin"])
+
+    hdr.add_comment(f"Calibrated using pyscope")
+    hdr.add_comment(f"Calibration mode: {camera_type}")
+    if dark_frame is not None:
+        hdr.add_comment(f"Calibration dark frame: {dark_frame}")
+    else:
+        hdr.add_comment(
+            f"Calibration dark frame not provided - dark subtraction NOT performed"
+        )
+    if flat_frame is not None:
+        hdr.add_comment(f"Calibration flat frame: {flat_frame}")
+    else:
+        hdr.add_comment(
+            f"Calibration flat frame not provided - flat correction NOT performed"
+        )
+    if bias_frame is not None:
+        hdr.add_comment(f"Calibration bias frame: {bias_frame}")
+    else:
+        hdr.add_comment(
+            f"Calibration bias frame not provided - bias subtraction NOT performed"
+        )
+    hdr.add_comment(f"Calibration astro-scrappy: {astro_scrappy}")
+    hdr.add_comment(f"Calibration bad columns: {bad_columns}")
 
-        logger.debug(f"Image readout mode: {image_readout_mode}")
-        logger.debug(f"Image gain: {image_gain}")
-        logger.debug(f"Image exposure time: {image_exptime}")
-        logger.debug(f"Image X binning: {image_xbin}")
-        logger.debug(f"Image Y binning: {image_ybin}")
+    if camera_type == "ccd":
+        if bias_frame is not None:
+            logger.info("Applying bias frame (CCD selected)...")
 
         if dark_frame is not None:
-            if image_readout_mode != dark_readout_mode:
-                logger.warning(
-                    f"Image readout mode ({image_readout_mode}) does not match dark readout mode ({dark_readout_mode})"
-                )
+            logger.info(
+                """Applying the dark frame. CCD selected so a bias-subtracted
+                        dark frame is scaled by the ratio of the image exposure time over
+                        the dark exposure time then subtracted from the image."""
+            )
+            # Images are grouped by exposure time, so the scaled dark is kept
+            # for the rest of the group and dropped when the next one starts
+            scaled_dark = scaled_darks.get(image_info["exptime"])
+            if scaled_dark is None:
+                scaled_darks.clear()
+                ratio = image_info["exptime"] / dark_info["exptime"]
+                if ratio == 1:
+                    scaled_dark = dark_minus_bias
+                else:
+                    scaled_dark = np.multiply(
+                        dark_minus_bias, ratio, out=np.empty_like(dark_minus_bias)
+                    )
+                scaled_darks[image_info["exptime"]] = scaled_dark
+
+    elif camera_type == "cmos":
+        if dark_frame is not None:
+            logger.info(
+                """Applying the dark frame. CMOS selected so a dark
+                        is subtracted from the image with no bias and no exposure time scaling."""
+            )
 
-            if image_xbin != dark_xbin:
-                logger.warning(
-                    f"Image X binning ({image_xbin}) does not match dark X binning ({dark_xbin})"
-                )
+    if flat_frame is not None:
+        logger.info("Applying the flat frame...")
+
+    logger.info("Flooring the calibrated image and adding pedestal of %s", pedestal)
+    hdr["PEDESTAL"] = pedestal
+    # Without any further processing the kernel clips and casts straight to
+    # uint16. Otherwise the image buffer is not needed afterwards, so it is
+    # calibrated in place and clipped once processing is done.
+    if astro_scrappy[0] > 0 or len(bad_cols) > 0:
+        out = image
+    else:
+        out = np.empty(image.shape, dtype=np.uint16)
+    cal_image = _calibrate_image(
+        image,
+        out,
+        pedestal,
+        bias=bias if camera_type == "ccd" and bias_frame is not None else None,
+        dark=scaled_dark,
+        flat=flat if flat_frame is not None else None,
+    )
 
-            if image_ybin != dark_ybin:
-                logger.warning(
-                    f"Image Y binning ({image_ybin}) does not match dark Y binning ({dark_ybin})"
-                )
+    if astro_scrappy[0] > 0:
+        logger.info("Removing hot pixels...")
+        t0 = time.time()
+        # astroscrappy works in float32, so the image is passed as a contiguous
+        # float32 array to avoid a conversion copy. Separable medians are
+        # requested explicitly as they are much faster than the full 5x5 median.
+        mask, cal_image = astroscrappy.detect_cosmics(
+            np.ascontiguousarray(cal_image, dtype=np.float32),
+            niter=astro_scrappy[0],
+            readnoise=astro_scrappy[1],
+            sepmed=True,
+        )
+        t = time.time() - t0
+        hdr.add_comment(
+            f"Removed hot pixels using astroscrappy, {astro_scrappy[0]} iterations"
+        )
+        hdr.add_comment("Hot pixel removal took %.1f seconds" % t)
+        logger.debug("Hot pixel removal took %s seconds", t)
+
+    if len(bad_cols) > 0:
+        logger.info("Fixing bad columns...")
+        # Columns on the edge of the image only have one neighbour, which is
+        # used on both sides
+        width = cal_image.shape[-1]
+        left = np.where(bad_cols > 0, bad_cols - 1, bad_cols + 1)
+        right = np.where(bad_cols < width - 1, bad_cols + 1, bad_cols - 1)
+        cal_image[:, bad_cols] = (cal_image[:, left] + cal_image[:, right]) / 2
+
+    if cal_image is image:
+        # The buffer is handed over to be written, possibly by another thread,
+        # so the next image has to be read into a new one
+        _calib_state["work"] = None
+
+    if in_place:
+        out_fname = fname
+    else:
+        out_fname = str(fname).split(".")[:-1][0] + "_cal.fts"
 
-            if image_gain != dark_gain:
-                logger.warning(
-                    f"Image gain ({image_gain}) does not match dark gain ({dark_gain})"
-                )
+    if write_queue is None:
+        _write_calibrated(out_fname, cal_image, hdr)
+    else:
+        write_queue.put((out_fname, cal_image, hdr))
 
-        if flat_frame is not None:
-            if image_readout_mode != flat_readout_mode:
-                logger.warning(
-                    f"Image readout mode ({image_readout_mode}) does not match flat readout mode ({flat_readout_mode})"
-                )
 
-            if image_xbin != flat_xbin:
-                logger.warning(
-                    f"Image X binning ({image_xbin}) does not match flat X binning ({flat_xbin})"
-                )
+def _write_calibrated(fname, cal_image, hdr):
+    """Clips a calibrated image to the uint16 range and writes it to a file."""
+    if cal_image.dtype != np.uint16:
+        logger.info("Clipping to uint16 range...")
+        cal_image = np.clip(cal_image, 0, 65535)
+        cal_image = cal_image.astype(np.uint16)
 
-            if image_ybin != flat_ybin:
-                logger.warning(
-                    f"Image Y binning ({image_ybin}) does not match flat Y binning ({flat_ybin})"
-                )
+    logger.info("Writing calibrated status to header...")
+    hdr["CALSTAT"] = True
+    logger.info("Writing calibrated image to %s", fname)
+    fits.writeto(fname, cal_image, hdr, overwrite=True)
 
-            if image_filter != flat_filter:
-                logger.warning(
-                    f"Image filter ({image_filter}) does not match flat filter ({flat_filter})"
-                )
+    logger.info("Done!")
 
-            if image_gain != flat_gain:
-                logger.warning(
-                    f"Image gain ({image_gain}) does not match flat gain ({flat_gain})"
-                )
 
-        if camera_type == "cmos":
-            if image_exptime != dark_exptime:
-                logger.warning(
-                    f"""Image exposure time ({image_exptime}) does not match dark exposure time ({dark_exptime}),
-                    recommended for a CMOS camera"""
-                )
+def _write_worker(write_queue, errors):
+    """Writes the images put on a queue until `None` is received.
 
-        elif camera_type == "ccd":
-            if image_readout_mode != bias_readout_mode:
-                logger.warning(
-                    f"Image readout mode ({image_readout_mode}) does not match bias readout mode ({bias_readout_mode})"
-                )
+    The first error is kept in `errors` and later images are dropped, but the
+    queue is still drained so that the calibrating thread never blocks.
+    """
+    for item in iter(write_queue.get, None):
+        if errors:
+            continue
+        try:
+            _write_calibrated(*item)
+        except Exception as e:
+            errors.append(e)
 
-            if image_xbin != bias_xbin:
-                logger.warning(
-                    f"Image X binning ({image_xbin}) does not match bias X binning ({bias_xbin})"
-                )
 
-            if image_ybin != bias_ybin:
-                logger.warning(
-                    f"Image Y binning ({image_ybin}) does not match bias Y binning ({bias_ybin})"
-                )
+def _check_frame_info(image_info):
+    """Warns about header attributes of an image that do not match the masters."""
+    camera_type = _calib_state["camera_type"]
+    bias_frame = _calib_state["bias_frame"]
+    dark_frame = _calib_state["dark_frame"]
+    flat_frame = _calib_state["flat_frame"]
+    bias_info = _calib_state["bias_info"]
+    dark_info = _calib_state["dark_info"]
+    flat_info = _calib_state["flat_info"]
 
-            if image_gain != bias_gain:
-                logger.warning(
-                    f"Image gain ({image_gain}) does not match bias gain ({bias_gain})"
-                )
+    if dark_frame is not None:
+        if image_info["readout_mode"] != dark_info["readout_mode"]:
+            logger.warning(
+                "Image readout mode (%s) does not match dark readout mode (%s)",
+                image_info["readout_mode"],
+                dark_info["readout_mode"],
+            )
 
-        hdr.add_comment(f"Calibrated using pyscope")
-        hdr.add_comment(f"Calibration mode: {camera_type}")
-        if dark_frame is not None:
-            hdr.add_comment(f"Calibration dark frame: {dark_frame}")
-        else:
-            hdr.add_comment(
-                f"Calibration dark frame not provided - dark subtraction NOT performed"
+        if image_info["xbin"] != dark_info["xbin"]:
+            logger.warning(
+                "Image X binning (%s) does not match dark X binning (%s)",
+                image_info["xbin"],
+                dark_info["xbin"],
             )
-        if flat_frame is not None:
-            hdr.add_comment(f"Calibration flat frame: {flat_frame}")
-        else:
-            hdr.add_comment(
-                f"Calibration flat frame not provided - flat correction NOT performed"
+
+        if image_info["ybin"] != dark_info["ybin"]:
+            logger.warning(
+                "Image Y binning (%s) does not match dark Y binning (%s)",
+                image_info["ybin"],
+                dark_info["ybin"],
             )
-        if bias_frame is not None:
-            hdr.add_comment(f"Calibration bias frame: {bias_frame}")
-        else:
-            hdr.add_comment(
-                f"Calibration bias frame not provided - bias subtraction NOT performed"
+
+        if image_info["gain"] != dark_info["gain"]:
+            logger.warning(
+                "Image gain (%s) does not match dark gain (%s)",
+                image_info["gain"],
+                dark_info["gain"],
             )
-        hdr.add_comment(f"Calibration astro-scrappy: {astro_scrappy}")
-        hdr.add_comment(f"Calibration bad columns: {bad_columns}")
-
-        cal_image = image.copy()
-        if camera_type == "ccd":
-            if bias_frame is not None:
-                logger.info("Applying bias frame (CCD selected)...")
-                cal_image = np.subtract(cal_image, bias)
-
-            if dark_frame is not None:
-                logger.info(
-                    """Applying the dark frame. CCD selected so a bias-subtracted
-                            dark frame is scaled by the ratio of the image exposure time over
-                            the dark exposure time then subtracted from the image."""
-                )
 
-                cal_image = np.subtract(
-                    cal_image, (dark - bias) * (image_exptime / dark_exptime)
-                )
+    if flat_frame is not None:
+        if image_info["readout_mode"] != flat_info["readout_mode"]:
+            logger.warning(
+                "Image readout mode (%s) does not match flat readout mode (%s)",
+                image_info["readout_mode"],
+                flat_info["readout_mode"],
+            )
 
-        elif camera_type == "cmos":
-            if dark_frame is not None:
-                logger.info(
-                    """Applying the dark frame. CMOS selected so a dark
-                            is subtracted from the image with no bias and no exposure time scaling."""
-                )
-                cal_image = np.subtract(cal_image, dark)
-
-        if flat_frame is not None:
-            logger.info("Checking if flat frame has a pedestal...")
-            if "PEDESTAL" in flat_hdr:
-                logger.info(f"Pedestal keyword found, value: {flat_hdr['PEDESTAL']}")
-                flat_pedestal = flat_hdr["PEDESTAL"]
-                logger.info(f"Subtracting pedestal of {flat_pedestal} from flat frame.")
-                flat = np.subtract(flat, flat_pedestal)
-
-            logger.info("Normalizing the flat frame by the mean of the entire image.")
-            flat_mean = np.mean(flat)
-            logger.info(f"flat_mean: {flat_mean}")
-            flat = np.divide(flat, flat_mean)
-
-            logger.info("Applying the flat frame...")
-            cal_image = np.divide(cal_image, flat)
-
-        logger.info("Flooring the calibrated image...")
-        cal_image = np.floor(cal_image)
-
-        logger.info(f"Adding pedestal of {pedestal}")
-        hdr["PEDESTAL"] = pedestal
-        cal_image += pedestal
-
-        if astro_scrappy[0] > 0:
-            logger.info("Removing hot pixels...")
-            t0 = time.time()
-            mask, cal_image = astroscrappy.detect_cosmics(
-                cal_image, niter=astro_scrappy[0], readnoise=astro_scrappy[1]
+        if image_info["xbin"] != flat_info["xbin"]:
+            logger.warning(
+                "Image X binning (%s) does not match flat X binning (%s)",
+                image_info["xbin"],
+                flat_info["xbin"],
             )
-            t = time.time() - t0
-            hdr.add_comment(
-                f"Removed hot pixels using astroscrappy, {astro_scrappy[0]} iterations"
+
+        if image_info["ybin"] != flat_info["ybin"]:
+            logger.warning(
+                "Image Y binning (%s) does not match flat Y binning (%s)",
+                image_info["ybin"],
+                flat_info["ybin"],
             )
-            hdr.add_comment("Hot pixel removal took %.1f seconds" % t)
-            logger.debug(f"Hot pixel removal took {t} seconds")
 
-        if len(bad_columns) > 0:
-            logger.info("Fixing bad columns...")
-            for badcol in bad_columns:
-                cal_image[:, badcol] = (
-                    cal_image[:, badcol - 1] + cal_image[:, badcol + 1]
-                ) / 2
+        if image_info["filter"] != flat_info["filter"]:
+            logger.warning(
+                "Image filter (%s) does not match flat filter (%s)",
+                image_info["filter"],
+                flat_info["filter"],
+            )
 
-        logger.info("Clipping to uint16 range...")
-        cal_image = np.clip(cal_image, 0, 65535)
-        cal_image = cal_image.astype(np.uint16)
+        if image_info["gain"] != flat_info["gain"]:
+            logger.warning(
+                "Image gain (%s) does not match flat gain (%s)",
+                image_info["gain"],
+                flat_info["gain"],
+            )
 
-        logger.info("Writing calibrated status to header...")
-        hdr["CALSTAT"] = True
-        if in_place:
-            logger.info(f"Overwriting {fname}")
-            fits.writeto(fname, cal_image, hdr, overwrite=True)
-        else:
-            logger.info(f"Writing calibrated image to {fname}")
-            fits.writeto(
-                str(fname).split(".")[:-1][0] + "_cal.fts", cal_image, hdr, overwrite=True
+    if camera_type == "cmos" and dark_frame is not None:
+        if image_info["exptime"] != dark_info["exptime"]:
+            logger.warning(
+                """Image exposure time (%s) does not match dark exposure time (%s),
+                recommended for a CMOS camera""",
+                image_info["exptime"],
+                dark_info["exptime"],
             )
 
-        logger.info("Done!")
+    elif camera_type == "ccd" and bias_frame is not None:
+        if image_info["readout_mode"] != bias_info["readout_mode"]:
+            logger.warning(
+                "Image readout mode (%s) does not match bias readout mode (%s)",
+                image_info["readout_mode"],
+                bias_info["readout_mode"],
+            )
+
+        if image_info["xbin"] != bias_info["xbin"]:
+            logger.warning(
+                "Image X binning (%s) does not match bias X binning (%s)",
+                image_info["xbin"],
+                bias_info["xbin"],
+            )
+
+        if image_info["ybin"] != bias_info["ybin"]:
+            logger.warning(
+                "Image Y binning (%s) does not match bias Y binning (%s)",
+                image_info["ybin"],
+                bias_info["ybin"],
+            )
+
+        if image_info["gain"] != bias_info["gain"]:
+            logger.warning(
+                "Image gain (%s) does not match bias gain (%s)",
+                image_info["gain"],
+                bias_info["gain"],
+            )
+
+
+def _calibrate_image(image, out, pedestal, bias=None, dark=None, flat=None):
+    """Computes ``floor((image - bias - dark) / flat) + pedestal``.
+
+    The calibration is applied as a chain of in-place operations on ``out``, one
+    strip of rows at a time, so that no full-frame temporaries are allocated.
+    ``out`` may be ``image`` itself to calibrate without any additional buffer.
+    If ``out`` is a uint16 array, the result is also clipped to the uint16 range
+    in the same pass. Any calibration frame passed as `None` is skipped.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Raw image data.
+    out : `numpy.ndarray`
+        Output buffer with the same shape as ``image``, or ``image`` itself. A
+        uint16 buffer receives the clipped image.
+    pedestal : `int`
+        Pedestal value added after flooring.
+    bias : `numpy.ndarray`, optional
+        Master bias frame.
+    dark : `numpy.ndarray`, optional
+        Master dark frame. For CCD cameras this should be bias-subtracted and
+        scaled to the exposure time of the image.
+    flat : `numpy.ndarray`, optional
+        Normalized master flat frame.
+
+    Returns
+    -------
+    `numpy.ndarray`
+        The calibrated image, i.e. ``out``.
+    """
+    clip = out.dtype == np.uint16
+    if numba is not None and image.ndim == 2:
+        return _calibrate_image_jit(image, out, pedestal, bias, dark, flat, clip)
+
+    # The chain is applied to strips of rows small enough that each strip stays
+    # in cache between operations, rather than streaming every full frame
+    # through memory once per operation
+    rows = max(1, _TILE_PIXELS // max(1, image[0].size))
+    work = np.empty((rows,) + image.shape[1:], dtype=image.dtype) if clip else None
+    for r0 in range(0, len(image), rows):
+        tile = slice(r0, r0 + rows)
+        # A uint16 output cannot hold the intermediate values, so those are
+        # kept in a strip-sized work buffer
+        tile_out = work[: len(image[tile])] if clip else out[tile]
+        if dark is not None:
+            np.subtract(image[tile], dark[tile], out=tile_out)
+        elif clip or out is not image:
+            np.copyto(tile_out, image[tile])
+        if bias is not None:
+            tile_out -= bias[tile]
+        if flat is not None:
+            tile_out /= flat[tile]
+        np.floor(tile_out, out=tile_out)
+        tile_out += pedestal
+        if clip:
+            np.clip(tile_out, 0, 65535, out=tile_out)
+            np.copyto(out[tile], tile_out, casting="unsafe")
+    return out
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def _calibrate_image_jit(image, out, pedestal, bias, dark, flat, clip):
+        """Compiled version of `_calibrate_image` for 2D images.
+
+        Each pixel is calibrated, and clipped if ``clip`` is set, in a single
+        pass, with the rows split across threads. Frames passed as `None` are
+        pruned at compile time. Fast math is not enabled, so that the result
+        is the same as the NumPy version.
+        """
+        for i in numba.prange(image.shape[0]):
+            for j in range(image.shape[1]):
+                value = image[i, j]
+                if dark is not None:
+                    value -= dark[i, j]
+                if bias is not None:
+                    value -= bias[i, j]
+                if flat is not None:
+                    value /= flat[i, j]
+                value = np.floor(value) + pedestal
+                if clip:
+                    value = min(max(value, 0), 65535)
+                out[i, j] = value
+        return out
 
 
 ccd_calib = ccd_calib_cli.callback
@@ -4,12 +4,12 @@ import logging
 
 import click
 import prettytable
-import timezonefinder
 from astropy import coordinates as coord
 from astropy import time as astrotime
 from astropy import units as u
 from astroquery.ipac.nexsci.nasa_exoplanet_archive import NasaExoplanetArchive
 
+from .. import utils
 from ..observatory import Observatory
 
 logger = logging.getLogger(__name__)
@@ -104,7 +104,7 @@ def exoplanet_transits_cli(
     if transit_depth_percent is not None:
         transit_depth = np.log10(1 + transit_depth_percent / 100) / 0.4
 
-    tz = timezonefinder.TimezoneFinder().timezone_at(lng=lon.deg, lat=lat.deg)
+    tz = utils._timezone_at(lon.deg, lat.deg)
     tz = zoneinfo.ZoneInfo(tz)
     logger.debug(f"tz = {tz}")
 
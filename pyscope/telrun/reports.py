@@ -167,24 +167,21 @@ def summary_report_cli(
             [hdr["OBSERVER"] for hdr in headers],
             fnames,
             [hdr["TARGET"] for hdr in headers],
-            [
-                astrotime.Time(hdr["DATE-OBS"], format="fits", scale="utc")
-                for hdr in headers
-            ],
-            [
-                astrotime.Time(row["start time (UTC)"], format="iso", scale="utc")
-                for row in schedule
-            ],
+            astrotime.Time(
+                [hdr["DATE-OBS"] for hdr in headers], format="fits", scale="utc"
+            ),
+            astrotime.Time(
+                list(schedule["start time (UTC)"]), format="iso", scale="utc"
+            ),
             [hdr.get("FILTER", "None") for hdr in headers],
             [hdr["READOUT"] for hdr in headers],
             [str(hdr["XBINNING"]) + "x" + str(hdr["YBINNING"]) for hdr in headers],
             [hdr["EXPTIME"] for hdr in headers],
-            [
-                coord.SkyCoord(
-                    hdr["SCHEDRA"], hdr["SCHEDDEC"], unit=("hourangle", "deg")
-                )
-                for hdr in headers
-            ],
+            coord.SkyCoord(
+                [hdr["SCHEDRA"] for hdr in headers],
+                [hdr["SCHEDDEC"] for hdr in headers],
+                unit=("hourangle", "deg"),
+            ),
             [hdr["AIRMASS"] for hdr in headers],
             [hdr.get("ZMAG", np.nan) for hdr in headers],
             [hdr.get("ZMAGERR", np.nan) for hdr in headers],
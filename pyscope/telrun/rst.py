@@ -8,13 +8,13 @@ import astroplan
 import click
 import numpy as np
 import prettytable
-import timezonefinder
 from astropy import coordinates as coord
 from astropy import table
 from astropy import time as astrotime
 from astropy import units as u
 from astroquery.mpc import MPC
 
+from .. import utils
 from ..observatory import Observatory
 
 logger = logging.getLogger(__name__)
@@ -190,7 +190,7 @@ def rst_cli(source=None, date=None, observatory="./config/observatory.cfg", verb
     logger.debug(f"lon = {lon}")
     logger.debug(f"name = {name}")
 
-    tz = timezonefinder.TimezoneFinder().timezone_at(lng=lon.deg, lat=lat.deg)
+    tz = utils._timezone_at(lon.deg, lat.deg)
     tz = zoneinfo.ZoneInfo(tz)
     logger.debug(f"tz = {tz}")
 
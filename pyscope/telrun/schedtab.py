@@ -375,7 +375,7 @@ def blocks_to_table(observing_blocks):
                             else False
                         ),
                     }
-                elif type(constraint) is astroplan.MoonSeparationConstraint:
+                elif isinstance(constraint, astroplan.MoonSeparationConstraint):
                     constraint_dict = {
                         "type": "MoonSeparationConstraint",
                         "min": (
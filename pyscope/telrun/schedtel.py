@@ -1,7 +1,13 @@
+import collections
+import concurrent.futures
 import configparser
 import datetime
+import functools
+import importlib.util
+import itertools
 import json
 import logging
+import multiprocessing
 import os
 import zoneinfo
 
@@ -10,9 +16,9 @@ import click
 import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
 import numpy as np
-import timezonefinder
 import tqdm
 from astroplan import plots as astroplan_plots
+from astroplan.target import get_skycoord
 from astropy import coordinates as coord
 from astropy import table
 from astropy import time as astrotime
@@ -196,6 +202,17 @@ C = completed
     show_default=True,
     help="""The time resolution of the schedule [seconds].""",
 )
+@click.option(
+    "-ai",
+    "--astrom-interp-minutes",
+    "astrom_interp_minutes",
+    type=click.FloatRange(min=0, clamp=True),
+    default=5,
+    show_default=True,
+    help="""The time resolution at which the astrometric parameters of
+    coordinate transformations are interpolated while scheduling [minutes].
+    Set to 0 to compute them exactly at every time.""",
+)
 @click.option(
     "-nf",
     "--name-format",
@@ -220,6 +237,18 @@ C = completed
     the file will be placed there. WARNING: If the file already exists,
     it will be overwritten.""",
 )
+@click.option(
+    "-of",
+    "--output-format",
+    "output_format",
+    type=click.Choice(["ecsv", "fits", "parquet"]),
+    default="ecsv",
+    show_default=True,
+    help="""The format of the output file. The binary formats are faster to
+    write and read for large schedules, but only .ecsv files are read by telrun,
+    so -t/--telrun always writes .ecsv. The extension of the file name is
+    replaced to match the format. Writing .parquet files requires pyarrow.""",
+)
 @click.option(
     "-t",
     "--telrun",
@@ -275,8 +304,10 @@ def schedtel_cli(
     scheduler=("", ""),
     gap_time=60,
     resolution=5,
+    astrom_interp_minutes=5,
     name_format="{code}_{target}_{filter}_{exposure}s_{start_time}",
     filename=None,
+    output_format="ecsv",
     telrun=False,
     plot=None,
     yes=False,
@@ -323,12 +354,20 @@ def schedtel_cli(
         Maximum transition time between observation blocks in seconds. Defaults to `60`.
     resolution : `float`, optional
         Time resolution for scheduling in seconds. Defaults to `5`.
+    astrom_interp_minutes : `float`, optional
+        Time resolution in minutes at which the astrometric parameters of the
+        coordinate transformations are interpolated while scheduling. `0`
+        computes them exactly at every time. Defaults to `5`.
     name_format : `str`, optional
         Format string for scheduled image names. Defaults to 
         `"{code}_{target}_{filter}_{exposure}s_{start_time}"`.
     filename : `str`, optional
         Output file name. If not specified, defaults to a file named with the UTC date 
         of the first observation in the current working directory.
+    output_format : `str`, optional
+        Format of the output file, one of `"ecsv"`, `"fits"` or `"parquet"`.
+        Only `.ecsv` files are read by telrun, so `.ecsv` is always written if
+        `telrun` is True. Defaults to `"ecsv"`.
     telrun : `bool`, optional
         If True, places the output file in the `$TELRUN_EXECUTE` directory or a default 
         `schedules/execute/` directory.
@@ -369,7 +408,9 @@ def schedtel_cli(
     logger.debug(f"scheduler: {scheduler}")
     logger.debug(f"gap_time: {gap_time}")
     logger.debug(f"resolution: {resolution}")
+    logger.debug(f"astrom_interp_minutes: {astrom_interp_minutes}")
     logger.debug(f"filename: {filename}")
+    logger.debug(f"output_format: {output_format}")
     logger.debug(f"telrun: {telrun}")
     logger.debug(f"plot: {plot}")
     logger.debug(f"quiet: {quiet}")
@@ -394,17 +435,8 @@ def schedtel_cli(
 
     logger.info("Parsing the observatory config")
     if type(observatory) is str:
-        obs_cfg = configparser.ConfigParser()
-        obs_cfg.read(observatory)
-        slew_rate = obs_cfg["scheduling"].getfloat("slew_rate") * u.deg / u.second
-        instrument_reconfig_times = json.loads(
-            obs_cfg["scheduling"].get("instrument_reconfig_times")
-        )
-        observatory = astroplan.Observer(
-            location=coord.EarthLocation(
-                lon=obs_cfg.get("site", "longitude"),
-                lat=obs_cfg.get("site", "latitude"),
-            )
+        observatory, slew_rate, instrument_reconfig_times = _load_observatory(
+            observatory
         )
         obs_lon = observatory.location.lon
         obs_lat = observatory.location.lat
@@ -428,7 +460,7 @@ def schedtel_cli(
         return
 
     # Schedule
-    tz = timezonefinder.TimezoneFinder().timezone_at(lng=obs_lon.deg, lat=obs_lat.deg)
+    tz = utils._timezone_at(obs_lon.deg, obs_lat.deg)
     tz = zoneinfo.ZoneInfo(tz)
     logger.debug(f"tz = {tz}")
 
@@ -492,23 +524,38 @@ def schedtel_cli(
                     logger.error(
                         f"File {f} in catalog {catalog} does not exist, skipping."
                     )
-                    continue
-                try:
-                    block_groups.append(
-                        sch.read(
-                            f,
-                            location=coord.EarthLocation(
-                                lon=obs_lon,
-                                lat=obs_lat,
-                            ),
-                            t0=t0,
-                        )
-                    )
-                except Exception as e:
+            sch_files = [f for f in sch_files if os.path.isfile(f)]
+
+            # Each .sch file is parsed independently, so large catalogs are
+            # parsed in separate processes. Every worker has to import astropy
+            # and astroplan first, which only pays off for many files. The
+            # workers are spawned rather than forked since forking a process
+            # that has started other threads can deadlock.
+            read = functools.partial(
+                _safe_read,
+                location=coord.EarthLocation(
+                    lon=obs_lon,
+                    lat=obs_lat,
+                ),
+                t0=t0,
+            )
+            workers = min(len(sch_files), os.cpu_count() or 1)
+            if len(sch_files) >= 8 and workers > 1:
+                with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                ) as executor:
+                    results = list(executor.map(read, sch_files))
+            else:
+                results = [read(f) for f in sch_files]
+
+            for f, result in zip(sch_files, results):
+                if isinstance(result, Exception):
                     logger.error(
-                        f"File {f} in catalog {catalog} is not a valid .sch file, skipping: {e}"
+                        f"File {f} in catalog {catalog} is not a valid .sch file, skipping: {result}"
                     )
                     continue
+                block_groups.append(result)
         elif catalog.endswith(".sch"):
             try:
                 block_groups.append(sch.read(catalog))
@@ -527,13 +574,7 @@ def schedtel_cli(
 
     if ignore_order:
         logger.info("Ignoring order of .sch files in catalog")
-        block_groups = [
-            [
-                block_groups[i][j]
-                for i in range(len(block_groups))
-                for j in range(len(block_groups[i]))
-            ]
-        ]
+        block_groups = [list(itertools.chain.from_iterable(block_groups))]
 
     # Add IDs to ObservingBlocks without them
     logger.info("Adding IDs to ObservingBlocks")
@@ -595,10 +636,15 @@ def schedtel_cli(
     # Constraints
     logger.info("Defining global constraints")
     global_constraints = [
-        astroplan.AtNightConstraint(max_solar_altitude=max_altitude * u.deg),
         astroplan.AltitudeConstraint(min=elevation * u.deg),
+        astroplan.AtNightConstraint(max_solar_altitude=max_altitude * u.deg),
+        _CachedMoonSeparationConstraint(
+            astroplan.time_grid_from_range(
+                [t0, t1], time_resolution=resolution * u.second
+            ),
+            min=moon_separation * u.deg,
+        ),
         astroplan.AirmassConstraint(max=airmass, boolean_constraint=False),
-        astroplan.MoonSeparationConstraint(min=moon_separation * u.deg),
     ]
 
     # Transitioner
@@ -621,15 +667,19 @@ def schedtel_cli(
         logger.debug(
             f"Updated instrument reconfiguration times {instrument_reconfig_times}"
         )
-    transitioner = astroplan.Transitioner(
-        slew_rate, instrument_reconfig_times=instrument_reconfig_times
+    transitioner = _CachedTransitioner(
+        [block for block_group in block_groups for block in block_group],
+        slew_rate,
+        instrument_reconfig_times=instrument_reconfig_times,
     )
 
     # Scheduler
     if scheduler == ("", ""):
         logger.info("Using default scheduler: astroplan.PriorityScheduler")
+        # Custom schedulers get the constraints as they are, since they may
+        # inspect them individually
         schedule_handler = astroplan.PriorityScheduler(
-            constraints=global_constraints,
+            constraints=[_ShortCircuitConstraints(global_constraints)],
             observer=observatory,
             transitioner=transitioner,
             gap_time=gap_time * u.second,
@@ -657,9 +707,19 @@ def schedtel_cli(
         )
 
     logger.info("Scheduling ObservingBlocks")
-    for i in tqdm.tqdm(range(len(block_groups))):
-        logger.debug("Block group %i of %i" % (i + 1, len(block_groups)))
-        schedule_handler(block_groups[i], schedule)
+    # The constraints transform every target to AltAz over a fine time grid,
+    # which is dominated by computing the astrometric parameters at each time.
+    # They vary slowly, so they are interpolated instead.
+    if astrom_interp_minutes > 0:
+        erfa_astrom = coord.erfa_astrom.ErfaAstromInterpolator(
+            astrom_interp_minutes * u.min
+        )
+    else:
+        erfa_astrom = coord.erfa_astrom.ErfaAstrom()
+    with coord.erfa_astrom.erfa_astrom.set(erfa_astrom):
+        for i in tqdm.tqdm(range(len(block_groups))):
+            logger.debug("Block group %i of %i" % (i + 1, len(block_groups)))
+            schedule_handler(block_groups[i], schedule)
 
     # Flatten block_groups for comparison with scheduled ObservingBlocks
     all_blocks = [block for block_group in block_groups for block in block_group]
@@ -677,74 +737,39 @@ def schedtel_cli(
     unscheduled_slots = [slot for slot in schedule.slots if slot.block is None]
 
     # Update ephem for non-sidereal targets, update object types, set filenames
-    for block_number, block in enumerate(scheduled_blocks):
+    nonsidereal_blocks = []
+    for block in scheduled_blocks:
         block.configuration["status"] = "S"
         block.configuration["message"] = "Scheduled"
 
+        # Record the global constraints individually rather than their wrapper
+        block.constraints = [
+            c
+            for constraint in block.constraints
+            for c in (
+                constraint.constraints
+                if isinstance(constraint, _ShortCircuitConstraints)
+                else [constraint]
+            )
+        ]
+
         if (
             block.configuration["pm_ra_cosdec"].value != 0
             or block.configuration["pm_dec"].value != 0
         ) and block.name != "":
-            logger.info("Updating ephemeris for '%s' at scheduled time" % block.name)
-            try:
-                ephemerides = mpc.MPC.get_ephemeris(
-                    target=block.name,
-                    location=observatory.location,
-                    start=block.start_time,
-                    number=1,
-                    proper_motion="sky",
-                )
-                new_ra = ephemerides["RA"][0]
-                new_dec = ephemerides["Dec"][0]
-                block.target = astroplan.FixedTarget(
-                    coord.SkyCoord(ra=new_ra, dec=new_dec)
+            nonsidereal_blocks.append(block)
+
+    # Each ephemeris is a separate query to the MPC, so they are made concurrently
+    if len(nonsidereal_blocks) > 0:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(
+                executor.map(
+                    functools.partial(_update_ephemeris, location=observatory.location),
+                    nonsidereal_blocks,
                 )
-                block.configuration["pm_ra_cosdec"] = (
-                    ephemerides["dRA cos(Dec)"][0] * u.arcsec / u.hour
-                )
-                block.configuration["pm_dec"] = (
-                    ephemerides["dDec"][0] * u.arcsec / u.hour
-                )
-            except Exception as e1:
-                try:
-                    logger.warning(
-                        f"Failed to find proper motions for {block.name}, trying to find proper motions using astropy.coordinates.get_body"
-                    )
-                    pos_l = coord.get_body(
-                        block.name,
-                        block.start_time - 10 * u.minute,
-                        location=observatory.location,
-                    )
-                    pos_m = coord.get_body(
-                        block.name,
-                        (block.start_time + block.end_time) / 2,
-                        location=location,
-                    )
-                    pos_h = coord.get_body(
-                        block.name,
-                        block.end_time + 10 * u.minute,
-                        location=observatory.location,
-                    )
-                    new_ra = pos_m.ra
-                    new_dec = pos_m.dec
-                    block.target = astroplan.FixedTarget(
-                        coord.SkyCoord(ra=new_ra, dec=new_dec)
-                    )
-                    block.configuration["pm_ra_cosdec"] = (
-                        (
-                            pos_h.ra * np.cos(pos_h.dec.rad)
-                            - pos_l.ra * np.cos(pos_l.dec.rad)
-                        )
-                        / (pos_h.obstime - pos_l.obstime)
-                    ).to(u.arcsec / u.hour)
-                    block.configuration["pm_dec"] = (
-                        (pos_h.dec - pos_l.dec) / (pos_h.obstime - pos_l.obstime)
-                    ).to(u.arcsec / u.hour)
-                except Exception as e2:
-                    logger.warning(
-                        f"Failed to find proper motions for {block.name}, keeping old ephemerides"
-                    )
+            )
 
+    for block_number, block in enumerate(scheduled_blocks):
         if block.configuration["filename"] == "":
             block.configuration["filename"] = name_format.format(
                 index=block_number,
@@ -882,9 +907,23 @@ def schedtel_cli(
 
     # Write the schedule to file
     logger.info("Writing schedule to file")
+    if telrun and output_format != "ecsv":
+        logger.warning(
+            "Option -t/--telrun requires .ecsv output, setting -of/--output-format to ecsv"
+        )
+        output_format = "ecsv"
+
     if filename is None or telrun:
         first_time = np.min(exec_table["start_time"]).strftime("%Y-%m-%dT%H-%M-%S")
-        filename = "telrun_" + first_time + ".ecsv"
+        filename = "telrun_" + first_time + "." + output_format
+    elif (
+        output_format != "ecsv"
+        and os.path.splitext(filename)[1].lower() not in _EXTENSIONS[output_format]
+    ):
+        logger.warning(
+            f"File {filename} does not have a {output_format} extension, replacing it"
+        )
+        filename = os.path.splitext(filename)[0] + "." + output_format
 
     write_queue = False
     if telrun:
@@ -910,7 +949,7 @@ def schedtel_cli(
         write_fname = filename
     else:
         write_fname = path + filename
-    exec_table.write(write_fname, overwrite=True, format="ascii.ecsv")
+    _write_table(exec_table, write_fname, output_format)
 
     # If a queue was passed, update the queue if --telrun is set
     # and the file was written to the expected location
@@ -967,14 +1006,7 @@ def plot_schedule_gantt_cli(schedule_table, observatory):
         schedule_table = table.Table.read(schedule_table, format="ascii.ecsv")
 
     if type(observatory) is str:
-        obs_cfg = configparser.ConfigParser()
-        obs_cfg.read(observatory)
-        observatory = astroplan.Observer(
-            location=coord.EarthLocation(
-                lon=obs_cfg.get("site", "longitude"),
-                lat=obs_cfg.get("site", "latitude"),
-            )
-        )
+        observatory = _load_observatory(observatory).observer
         obs_lon = observatory.location.lon
         obs_lat = observatory.location.lat
     elif type(observatory) is Observatory:
@@ -990,7 +1022,7 @@ def plot_schedule_gantt_cli(schedule_table, observatory):
         return
     location = coord.EarthLocation(lon=obs_lon, lat=obs_lat)
 
-    tz = timezonefinder.TimezoneFinder().timezone_at(lng=obs_lon.deg, lat=obs_lat.deg)
+    tz = utils._timezone_at(obs_lon.deg, obs_lat.deg)
     tz = zoneinfo.ZoneInfo(tz)
     date = str(np.min(schedule_table["start_time"]).isot)
     date = datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.%f")
@@ -1002,7 +1034,16 @@ def plot_schedule_gantt_cli(schedule_table, observatory):
     # Only keep scheduled blocks
     schedule_table = schedule_table[schedule_table["status"] == "S"]
 
-    obscodes = list(np.unique(schedule_table["code"]))
+    # The time columns are masked when the schedule holds unscheduled blocks,
+    # but every scheduled block has its times
+    start_time = schedule_table["start_time"].unmasked
+    end_time = schedule_table["end_time"].unmasked
+
+    # The index of each row's code comes with the sorted unique codes
+    obscodes, row_code = np.unique(
+        np.asarray(schedule_table["code"]), return_inverse=True
+    )
+    obscodes = list(obscodes)
 
     fig, ax = plt.subplots(1, 1, figsize=(12, len(obscodes) * 0.75))
     mdates.set_epoch(t0.strftime("%Y-%m-%dT%H:%M:%S"))
@@ -1011,75 +1052,57 @@ def plot_schedule_gantt_cli(schedule_table, observatory):
     y_labels = obscodes.copy()
     y_labels.append("All")
 
-    for i in range(len(obscodes)):
-        print(f"Plotting observer {obscodes[i]}")
-        plot_blocks = [
-            block for block in schedule_table if block["code"] == obscodes[i]
-        ]
-
-        for block in plot_blocks:
-            start_time = astrotime.Time(np.float64(block["start_time"].jd), format="jd")
-            end_time = astrotime.Time(np.float64(block["end_time"].jd), format="jd")
-            length_min = int((end_time - start_time).sec / 60 + 1)
-            times = (
-                start_time
-                + np.linspace(0, length_min, length_min, endpoint=True) * u.minute
-            )
-            airmass = []
-            for t in times:
-                obj = coord.SkyCoord(
-                    block["target"], obstime=t, location=location
-                ).transform_to("altaz")
-                airmass.append(utils.airmass(obj.alt.rad))
-
-            ax.scatter(
-                times.datetime,
-                i * np.ones(len(times)),
-                lw=0,
-                marker="s",
-                c=airmass,
-                cmap=ccm.batlow,
-                vmin=1,
-                vmax=2.3,
-            )
+    # Sample every block about once a minute, with the samples of all blocks
+    # laid end to end so that every target is transformed in a single call
+    length_min = (np.round((end_time - start_time).sec / 60) + 1).astype(int)
+    bounds = np.concatenate([[0], np.cumsum(length_min)])
+    block_index = np.repeat(np.arange(len(schedule_table)), length_min)
+    step = np.arange(bounds[-1]) - bounds[block_index]
+    spacing = length_min / np.maximum(length_min - 1, 1)
+    all_times = start_time[block_index] + step * spacing[block_index] * u.minute
+    with coord.erfa_astrom.erfa_astrom.set(
+        coord.erfa_astrom.ErfaAstromInterpolator(5 * u.min)
+    ):
+        altaz = schedule_table["target"][block_index].transform_to(
+            coord.AltAz(obstime=all_times, location=location)
+        )
+    all_airmass = utils.airmass(altaz.alt.rad)
+
+    # Draw the samples of all blocks at once, in the same order as the blocks
+    # would be drawn one by one (by code, then in schedule order), on the row
+    # of their code and on the "All" row
+    order = np.argsort(row_code, kind="stable")
+    row_rank = np.empty(len(schedule_table), dtype=int)
+    row_rank[order] = np.arange(len(schedule_table))
+    samples = np.argsort(row_rank[block_index], kind="stable")
+    sample_times = all_times[samples].datetime
+    sample_airmass = all_airmass[samples]
+
+    ax.scatter(
+        sample_times,
+        row_code[block_index][samples],
+        lw=0,
+        marker="s",
+        c=sample_airmass,
+        cmap=ccm.batlow,
+        vmin=1,
+        vmax=2.3,
+    )
 
-            scatter = ax.scatter(
-                times.datetime,
-                len(obscodes) * np.ones(len(times)),
-                lw=0,
-                marker="s",
-                c=airmass,
-                cmap=ccm.batlow,
-                vmin=1,
-                vmax=2.3,
-            )
+    scatter = ax.scatter(
+        sample_times,
+        len(obscodes) * np.ones(len(samples)),
+        lw=0,
+        marker="s",
+        c=sample_airmass,
+        cmap=ccm.batlow,
+        vmin=1,
+        vmax=2.3,
+    )
 
     # obscodes.append("All")
 
-    twilight_times = [
-        t0,
-        astrotime.Time(observatory.sun_set_time(t0, which="next"), scale="utc"),
-        astrotime.Time(
-            observatory.twilight_evening_civil(t0, which="next"), scale="utc"
-        ),
-        astrotime.Time(
-            observatory.twilight_evening_nautical(t0, which="next"), scale="utc"
-        ),
-        astrotime.Time(
-            observatory.twilight_evening_astronomical(t0, which="next"), scale="utc"
-        ),
-        astrotime.Time(
-            observatory.twilight_morning_astronomical(t0, which="next"), scale="utc"
-        ),
-        astrotime.Time(
-            observatory.twilight_morning_nautical(t0, which="next"), scale="utc"
-        ),
-        astrotime.Time(
-            observatory.twilight_morning_civil(t0, which="next"), scale="utc"
-        ),
-        astrotime.Time(observatory.sun_rise_time(t0, which="next"), scale="utc"),
-        t1,
-    ]
+    twilight_times = [t0, *_sun_events(obs_lon.deg, obs_lat.deg, t0.jd), t1]
     opacities = [0.8, 0.6, 0.4, 0.2, 0, 0.2, 0.4, 0.6, 0.8]
     for i in range(len(twilight_times) - 1):
         ax.axvspan(
@@ -1168,14 +1191,7 @@ def plot_schedule_sky_cli(schedule_table, observatory):
     schedule_table = schedule_table[schedule_table["status"] == "S"]
 
     if type(observatory) is str:
-        obs_cfg = configparser.ConfigParser()
-        obs_cfg.read(observatory)
-        observatory = astroplan.Observer(
-            location=coord.EarthLocation(
-                lon=obs_cfg.get("site", "longitude"),
-                lat=obs_cfg.get("site", "latitude"),
-            )
-        )
+        observatory = _load_observatory(observatory).observer
         obs_lon = observatory.location.lon
         obs_lat = observatory.location.lat
     elif type(observatory) is Observatory:
@@ -1190,39 +1206,36 @@ def plot_schedule_sky_cli(schedule_table, observatory):
         )
         return
 
-    # Get unique targets in the schedule
-    target_times = {}
-
-    for row in schedule_table:
-        if row["name"] == "TransitionBlock" or row["name"] == "EmptyBlock":
-            continue
-        target_string = row["target"].to_string("hmsdms")
-        target_name = row["name"]
-        if target_string not in target_times:
-            target_times[target_string] = {
-                "name": target_name,
-                "times": [row["start_time"]],
-            }
-        else:
-            target_times[target_string]["times"].append(row["start_time"])
+    # Group the blocks by the coordinates of their targets, numbering the
+    # targets in the order they first appear in the schedule
+    blocks = schedule_table[
+        (schedule_table["name"] != "TransitionBlock")
+        & (schedule_table["name"] != "EmptyBlock")
+    ]
+    _, first, inverse = np.unique(
+        np.column_stack([blocks["target"].ra.deg, blocks["target"].dec.deg]),
+        axis=0,
+        return_index=True,
+        return_inverse=True,
+    )
+    groups = np.argsort(np.argsort(first))[inverse.ravel()]
+    order = np.argsort(groups, kind="stable")
+    bounds = np.searchsorted(groups[order], np.arange(len(first) + 1))
+    names = np.ma.filled(blocks["name"], "")
 
-    # targets = [t.to_string("hmsdms") for t in schedule_table["target"]]
+    colors = ccm.batlow(np.linspace(0, 1, max(len(first), 1)))
 
     fig, ax = plt.subplots(1, 1, figsize=(7, 7), subplot_kw={"projection": "polar"})
-    for target, target_dict in target_times.items():
-        times = target_dict["times"]
-        try:
-            label = target_dict["name"]
-        except:
-            label = target.to_string("hmsdms")
-        target = coord.SkyCoord(target, unit=(u.hourangle, u.deg))
+    for i, color in enumerate(colors[: len(first)]):
+        rows = order[bounds[i] : bounds[i + 1]]
+        target = blocks["target"][rows[0]]
+        label = names[rows[0]] or target.to_string("hmsdms")
         ax = astroplan_plots.plot_sky(
             astroplan.FixedTarget(target),
             observatory,
-            times,
-            astrotime.Time(np.float64(row["start_time"].jd), format="jd"),
+            blocks["start_time"][rows],
             ax=ax,
-            style_kwargs={"label": label},
+            style_kwargs={"color": color, "label": label},
         )
 
     handles, labels = ax.get_legend_handles_labels()
@@ -1242,6 +1255,343 @@ def plot_schedule_sky_cli(schedule_table, observatory):
     return fig, ax
 
 
+_ObservatoryConfig = collections.namedtuple(
+    "_ObservatoryConfig", ["observer", "slew_rate", "instrument_reconfig_times"]
+)
+
+
+def _load_observatory(path):
+    """Reads the site and scheduling settings of an observatory config file.
+
+    Parsed configs are cached until the file is modified, so that scheduling and
+    plotting repeatedly with the same observatory only reads it once. A new
+    `~astroplan.Observer` and reconfiguration times are returned by each call,
+    since the observer keeps caches of its own and both may be modified.
+    """
+    path = os.path.abspath(path)
+    location, slew_rate, instrument_reconfig_times = _read_observatory(
+        path, os.stat(path).st_mtime_ns
+    )
+    if instrument_reconfig_times is not None:
+        instrument_reconfig_times = json.loads(instrument_reconfig_times)
+    return _ObservatoryConfig(
+        astroplan.Observer(location=location), slew_rate, instrument_reconfig_times
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _read_observatory(path, mtime_ns):
+    obs_cfg = configparser.ConfigParser()
+    obs_cfg.read(path)
+    location = coord.EarthLocation(
+        lon=obs_cfg.get("site", "longitude"),
+        lat=obs_cfg.get("site", "latitude"),
+    )
+
+    # The plotting functions only need the site. The reconfiguration times are
+    # kept as JSON so that every caller gets its own dictionary.
+    slew_rate = None
+    instrument_reconfig_times = None
+    if obs_cfg.has_section("scheduling"):
+        slew_rate = obs_cfg["scheduling"].getfloat("slew_rate") * u.deg / u.second
+        instrument_reconfig_times = obs_cfg["scheduling"].get(
+            "instrument_reconfig_times"
+        )
+
+    return location, slew_rate, instrument_reconfig_times
+
+
+class _ShortCircuitConstraints(astroplan.Constraint):
+    """Combines several constraints, evaluating each one only at the times where
+    some target still satisfies the previous ones.
+
+    The constraints are applied in the given order, so the cheap ones that rule
+    out the most times should come first. This mostly saves computing the
+    positions of the Sun and Moon while no target is observable anyway.
+    """
+
+    def __init__(self, constraints):
+        self.constraints = list(constraints)
+
+    def compute_constraint(self, times, observer, targets):
+        if targets is None:
+            shape = times.shape
+        else:
+            shape = np.broadcast_shapes(times.shape, targets.shape)
+        result = np.ones(shape)
+
+        if times.ndim != 1:
+            for constraint in self.constraints:
+                result *= constraint.compute_constraint(times, observer, targets)
+            return result
+
+        alive = np.ones(times.shape, dtype=bool)
+        for constraint in self.constraints:
+            result[..., alive] *= constraint.compute_constraint(
+                times[alive], observer, targets
+            )
+            alive &= np.any(result != 0, axis=tuple(range(result.ndim - 1)))
+            if not alive.any():
+                break
+
+        return result
+
+
+class _CachedMoonSeparationConstraint(astroplan.MoonSeparationConstraint):
+    """A `~astroplan.MoonSeparationConstraint` that remembers the position of
+    the Moon on the time grid of the schedule.
+
+    The position of the Moon does not depend on the targets, but astroplan
+    computes it again every time the constraint is evaluated. Here each time of
+    ``time_grid`` is only computed the first time it is needed. Times off the
+    grid fall back to `~astroplan.MoonSeparationConstraint`.
+    """
+
+    def __init__(self, time_grid, min=None, max=None, ephemeris=None):
+        super().__init__(min=min, max=max, ephemeris=ephemeris)
+        self._jd = time_grid.jd
+        self._step = self._jd[1] - self._jd[0] if len(self._jd) > 1 else 1
+        self._computed = np.zeros(len(self._jd), dtype=bool)
+        self._moon = np.empty((3, len(self._jd)))
+        self._obsgeoloc = np.empty((3, len(self._jd)))
+        self._obsgeovel = np.empty((3, len(self._jd)))
+
+    def compute_constraint(self, times, observer, targets):
+        if times.ndim != 1 or len(self._jd) == 0:
+            return super().compute_constraint(times, observer, targets)
+        idx = np.rint((times.jd - self._jd[0]) / self._step).astype(int)
+        if np.any((idx < 0) | (idx >= len(self._jd))) or np.any(
+            np.abs(self._jd[idx] - times.jd) > 1e-3 * self._step
+        ):
+            return super().compute_constraint(times, observer, targets)
+
+        missing = np.unique(idx[~self._computed[idx]])
+        if len(missing) > 0:
+            moon = coord.get_body(
+                "moon",
+                astrotime.Time(self._jd[missing], format="jd"),
+                location=observer.location,
+                ephemeris=self.ephemeris,
+            )
+            self._moon[:, missing] = moon.cartesian.xyz.to_value(u.km)
+            self._obsgeoloc[:, missing] = moon.obsgeoloc.xyz.to_value(u.m)
+            self._obsgeovel[:, missing] = moon.obsgeovel.xyz.to_value(u.m / u.s)
+            self._computed[missing] = True
+
+        moon = coord.SkyCoord(
+            coord.CartesianRepresentation(self._moon[:, idx], unit=u.km),
+            frame=coord.GCRS(
+                obstime=times,
+                obsgeoloc=coord.CartesianRepresentation(
+                    self._obsgeoloc[:, idx], unit=u.m
+                ),
+                obsgeovel=coord.CartesianRepresentation(
+                    self._obsgeovel[:, idx], unit=u.m / u.s
+                ),
+            ),
+        )
+        # As in astroplan, the separation is measured in the frame of the Moon
+        moon_separation = moon.separation(get_skycoord(targets))
+
+        if self.min is None and self.max is not None:
+            mask = self.max >= moon_separation
+        elif self.max is None and self.min is not None:
+            mask = self.min <= moon_separation
+        elif self.min is not None and self.max is not None:
+            mask = (self.min <= moon_separation) & (moon_separation <= self.max)
+        else:
+            raise ValueError("No max and/or min specified in MoonSeparationConstraint.")
+        return mask
+
+
+class _CachedTransitioner(astroplan.Transitioner):
+    """A `~astroplan.Transitioner` with the transitions between a fixed set of
+    blocks precomputed.
+
+    The scheduler asks for the transition between the same pairs of blocks many
+    times. The angular separation between two targets does not depend on the
+    frame it is measured in, so the slew times are taken from a matrix of
+    separations of the ICRS coordinates rather than transforming both targets
+    to AltAz at every call, and the instrument reconfigurations of each pair are
+    only looked up once. Blocks outside of the precomputed set fall back to
+    `~astroplan.Transitioner`.
+
+    The scheduler works on shallow copies of the blocks, so they are
+    recognized by their configuration dictionaries, which the copies share.
+    """
+
+    def __init__(self, blocks, slew_rate=None, instrument_reconfig_times=None):
+        super().__init__(
+            slew_rate=slew_rate, instrument_reconfig_times=instrument_reconfig_times
+        )
+        self._blocks = list(blocks)
+        self._index = {
+            id(block.configuration): i for i, block in enumerate(self._blocks)
+        }
+        self._components = {}
+        self._slew_times = None
+        if self.slew_rate is not None and len(self._blocks) > 0:
+            ra = np.array([block.target.ra.rad for block in self._blocks])
+            dec = np.array([block.target.dec.rad for block in self._blocks])
+            sep = coord.angular_separation(
+                ra[:, None], dec[:, None], ra[None, :], dec[None, :]
+            )
+            self._slew_times = sep / self.slew_rate.to_value(u.rad / u.second)
+
+    def __call__(self, oldblock, newblock, start_time, observer):
+        i = self._index.get(id(getattr(oldblock, "configuration", None)))
+        j = self._index.get(id(getattr(newblock, "configuration", None)))
+        if i is None or j is None:
+            return super().__call__(oldblock, newblock, start_time, observer)
+
+        components = self._components.get((i, j))
+        if components is None:
+            components = {}
+            if self._slew_times is not None and oldblock.target != newblock.target:
+                if self._slew_times[i, j] > 1:
+                    components["slew_time"] = self._slew_times[i, j] * u.second
+            if self.instrument_reconfig_times is not None:
+                components.update(
+                    self.compute_instrument_transitions(oldblock, newblock)
+                )
+            self._components[(i, j)] = components
+
+        if components:
+            return astroplan.TransitionBlock(dict(components), start_time)
+        else:
+            return None
+
+
+_EXTENSIONS = {
+    "ecsv": (".ecsv",),
+    "fits": (".fits", ".fit", ".fts"),
+    "parquet": (".parquet",),
+}
+
+
+def _write_table(tbl, fname, output_format):
+    """Writes a schedule table as .ecsv, .fits or .parquet.
+
+    The binary formats cannot hold object columns such as the constraints, so
+    those are written as JSON strings, as they are stored in .ecsv files.
+    """
+    if output_format == "ecsv":
+        tbl.write(fname, overwrite=True, format="ascii.ecsv")
+        return
+
+    tbl = tbl.copy(copy_data=False)
+    for name in tbl.colnames:
+        if getattr(tbl[name], "dtype", None) == object:
+            tbl[name] = [
+                json.dumps(np.asarray(value).tolist(), default=str)
+                for value in tbl[name]
+            ]
+    tbl.write(fname, overwrite=True, format=output_format)
+
+
+def _safe_read(fname, location, t0):
+    """Reads a .sch file, returning the exception instead of raising it so
+    that one invalid file does not stop the others from being read.
+    """
+    try:
+        return sch.read(fname, location=location, t0=t0)
+    except Exception as e:
+        return e
+
+
+def _update_ephemeris(block, location):
+    """Updates the position and proper motions of a non-sidereal target to the
+    scheduled time of its block, keeping the old ephemerides if neither the MPC
+    nor `astropy.coordinates.get_body` know the target."""
+    logger.info("Updating ephemeris for '%s' at scheduled time" % block.name)
+    try:
+        ephemerides = mpc.MPC.get_ephemeris(
+            target=block.name,
+            location=location,
+            start=block.start_time,
+            number=1,
+            proper_motion="sky",
+        )
+        new_ra = ephemerides["RA"][0]
+        new_dec = ephemerides["Dec"][0]
+        block.target = coord.SkyCoord(ra=new_ra, dec=new_dec)
+        block.configuration["pm_ra_cosdec"] = (
+            ephemerides["dRA cos(Dec)"][0] * u.arcsec / u.hour
+        )
+        block.configuration["pm_dec"] = ephemerides["dDec"][0] * u.arcsec / u.hour
+    except Exception as e1:
+        try:
+            logger.warning(
+                f"Failed to find proper motions for {block.name}, trying to find proper motions using astropy.coordinates.get_body"
+            )
+            # get_body is vectorized over time, so the positions before, during
+            # and after the block are found with a single call
+            times = astrotime.Time(
+                [
+                    block.start_time - 10 * u.minute,
+                    block.start_time + (block.end_time - block.start_time) / 2,
+                    block.end_time + 10 * u.minute,
+                ]
+            )
+            pos_l, pos_m, pos_h = coord.get_body(block.name, times, location=location)
+            new_ra = pos_m.ra
+            new_dec = pos_m.dec
+            block.target = coord.SkyCoord(ra=new_ra, dec=new_dec)
+
+            # The rates are found with plain floats, wrapping the change in RA
+            # across 0h, and the units are attached at the end
+            ra_l, ra_h = pos_l.ra.rad, pos_h.ra.rad
+            dec_l, dec_h = pos_l.dec.rad, pos_h.dec.rad
+            dt = (pos_h.obstime - pos_l.obstime).sec
+            dra = np.arctan2(np.sin(ra_h - ra_l), np.cos(ra_h - ra_l))
+            rad_per_s = (u.rad / u.second).to(u.arcsec / u.hour)
+            block.configuration["pm_ra_cosdec"] = (
+                dra * np.cos((dec_h + dec_l) / 2) / dt * rad_per_s * u.arcsec / u.hour
+            )
+            block.configuration["pm_dec"] = (
+                (dec_h - dec_l) / dt * rad_per_s * u.arcsec / u.hour
+            )
+        except Exception as e2:
+            logger.warning(
+                f"Failed to find proper motions for {block.name}, keeping old ephemerides"
+            )
+
+
+@functools.lru_cache(maxsize=16)
+def _sun_events(lon, lat, jd):
+    """Finds sunset, the evening and morning twilights, and sunrise following a
+    time, in that order.
+
+    Rather than root-finding each event separately, the altitude of the Sun is
+    sampled every minute for a day and every event is interpolated from the
+    same samples. Events that do not happen within the day, e.g. at high
+    latitudes, are placed at its end. The result is cached by location and
+    time since a chart is usually plotted more than once for the same night.
+    """
+    observer = astroplan.Observer(
+        location=coord.EarthLocation(lon=lon * u.deg, lat=lat * u.deg)
+    )
+    times = astrotime.Time(jd, format="jd") + np.linspace(0, 1, 1441) * u.day
+    with coord.erfa_astrom.erfa_astrom.set(
+        coord.erfa_astrom.ErfaAstromInterpolator(5 * u.min)
+    ):
+        sun_alt = observer.sun_altaz(times).alt.deg
+
+    def crossing(horizon, rising):
+        above = sun_alt > horizon
+        idx = np.flatnonzero(above[1:] != above[:-1])
+        idx = idx[above[idx + 1] == rising]
+        if len(idx) == 0:
+            return times[-1]
+        i = idx[0]
+        frac = (horizon - sun_alt[i]) / (sun_alt[i + 1] - sun_alt[i])
+        return times[i] + frac * (times[i + 1] - times[i])
+
+    evening = [crossing(horizon, False) for horizon in (0, -6, -12, -18)]
+    morning = [crossing(horizon, True) for horizon in (-18, -12, -6, 0)]
+    return tuple(evening + morning)
+
+
 def format_exptime(exptime):
     return (
         f"{exptime:.0f}" if exptime.is_integer() else f"{exptime:.2g}".replace(".", "-")
@@ -1,6 +1,7 @@
 from ._args_kwargs_config import _kwargs_to_config
 from ._function_synchronicity import _force_async, _force_sync
 from ._html_line_parser import _get_number_from_line
+from ._timezone import _timezone_at
 from .airmass import airmass
 from .pyscope_exception import PyscopeException
 
@@ -0,0 +1,20 @@
+import functools
+
+import timezonefinder
+
+
+@functools.lru_cache(maxsize=1)
+def _timezone_finder():
+    return timezonefinder.TimezoneFinder()
+
+
+@functools.lru_cache(maxsize=64)
+def _timezone_at(lon, lat):
+    """
+    Find the name of the time zone at a site given its longitude and latitude
+    in degrees.
+
+    Creating a TimezoneFinder loads its polygon index, so a single finder is
+    shared by all lookups and the time zone of each site is only looked up once.
+    """
+    return _timezone_finder().timezone_at(lng=lon, lat=lat)
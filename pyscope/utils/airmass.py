@@ -1,7 +1,29 @@
 import numpy as np
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 def airmass(alt):
     """Calculates the airmass given an altitude via Pickering 2002"""
+    if numba is not None:
+        alt = np.asarray(alt, dtype=np.float64)
+        return _airmass_jit(alt.ravel()).reshape(alt.shape)[()]
+
     deg = np.pi / 180
     return 1 / np.sin((alt / deg + 244 / (165 + 47 * (alt / deg) ** 1.1)) * deg)
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _airmass_jit(alt):
+        """Compiled version of `airmass` for a 1D array of altitudes in radians."""
+        deg = np.pi / 180
+        out = np.empty_like(alt)
+        for i in numba.prange(alt.shape[0]):
+            h = alt[i] / deg
+            out[i] = 1 / np.sin((h + 244 / (165 + 47 * h**1.1)) * deg)
+        return out
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The test modules import the image simulation helpers next to them
+sys.path.insert(0, os.path.dirname(__file__))
@@ -5,17 +5,30 @@
 ## if equal, then it passes the test
 ## Follow guideline Will sent
 
+import importlib
 import os
 import shutil
+import time
 
 import image_sim as imsim
 import matplotlib.pyplot as plt
 import numpy as np
 import pytest
 from astropy.io import fits
+from click.testing import CliRunner
 from convenience_functions import show_image
 
 from pyscope.reduction import ccd_calib
+from pyscope.reduction.ccd_calib import (
+    _calib_state,
+    _hget,
+    _init_calib_state,
+    _load_master,
+    _npy_path,
+    ccd_calib_cli,
+)
+
+ccd_calib_module = importlib.import_module("pyscope.reduction.ccd_calib")
 
 
 def test_ccd_calib(tmp_path):
@@ -430,6 +443,350 @@ def test_ccd_calib(tmp_path):
     return
 
 
+def _write_frame(fname, data, imagetyp, exptime):
+    hdr = fits.Header()
+    hdr["IMAGETYP"] = imagetyp
+    hdr["READOUTM"] = "highgain"
+    hdr["EXPTIME"] = exptime
+    hdr["XBINNING"] = 1
+    hdr["YBINNING"] = 1
+    fits.writeto(fname, data, hdr, overwrite=True)
+
+
+@pytest.fixture
+def frames(tmp_path):
+    """Small master frames and raw images taken with two exposure times."""
+    rng = np.random.default_rng(0)
+    shape = (64, 48)
+    masters = dict(
+        bias_frame=str(tmp_path / "master-bias.fts"),
+        dark_frame=str(tmp_path / "master-dark.fts"),
+        flat_frame=str(tmp_path / "master-flat.fts"),
+    )
+    _write_frame(
+        masters["bias_frame"],
+        rng.normal(1000, 5, shape).astype(np.float32),
+        "Bias Frame",
+        0.0,
+    )
+    _write_frame(
+        masters["dark_frame"],
+        rng.normal(1060, 5, shape).astype(np.float32),
+        "Dark Frame",
+        60.0,
+    )
+    _write_frame(
+        masters["flat_frame"],
+        rng.normal(20000, 50, shape).astype(np.float32),
+        "Flat Field",
+        1.0,
+    )
+
+    os.makedirs(tmp_path / "raw")
+    for i in range(4):
+        _write_frame(
+            str(tmp_path / "raw" / f"image{i}.fts"),
+            rng.normal(1500, 20, shape).astype(np.uint16),
+            "Light Frame",
+            30.0 if i % 2 else 60.0,
+        )
+    return masters
+
+
+def _calibrated(tmp_path):
+    fnames = sorted((tmp_path / "raw").glob("*_cal.fts"))
+    data = [fits.getdata(fname) for fname in fnames]
+    for fname in fnames:
+        os.remove(fname)
+    return data
+
+
+def test_ccd_calib_workers(tmp_path, frames):
+    ccd_calib(fnames=str(tmp_path / "raw"), astro_scrappy=(0, 3), workers=1, **frames)
+    # The masters are not kept in memory once done
+    assert not _calib_state
+    serial = _calibrated(tmp_path)
+    ccd_calib(fnames=str(tmp_path / "raw"), astro_scrappy=(0, 3), workers=2, **frames)
+    parallel = _calibrated(tmp_path)
+
+    assert len(serial) == 4
+    for a, b in zip(serial, parallel):
+        assert a.dtype == np.uint16
+        np.testing.assert_array_equal(a, b)
+
+
+def test_ccd_calib_cli_workers(tmp_path, frames):
+    result = CliRunner().invoke(
+        ccd_calib_cli,
+        [
+            "-b",
+            frames["bias_frame"],
+            "-d",
+            frames["dark_frame"],
+            "-f",
+            frames["flat_frame"],
+            "-s",
+            "0",
+            "3",
+            "-w",
+            "2",
+            str(tmp_path / "raw"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert len(_calibrated(tmp_path)) == 4
+
+
+def test_init_calib_state_memmaps_masters(tmp_path):
+    flat = _npy_path(np.ones((4, 4), dtype=np.float32), str(tmp_path / "flat"))
+    _init_calib_state(dict(bias=None, dark_minus_bias=None, flat=flat))
+
+    assert isinstance(_calib_state["flat"], np.memmap)
+    assert _calib_state["bias"] is None
+    # Frames that are already memory-mapped are not saved again
+    assert _npy_path(_calib_state["flat"], str(tmp_path / "other")) == flat
+    assert not os.path.exists(tmp_path / "other.npy")
+
+
+def test_ccd_calib_reads_headers_once(tmp_path, frames, monkeypatch):
+    calls = []
+    read_header = ccd_calib_module._read_header
+    monkeypatch.setattr(
+        ccd_calib_module,
+        "_read_header",
+        lambda path: calls.append(path) or read_header(path),
+    )
+    fnames = sorted(str(fname) for fname in (tmp_path / "raw").glob("*.fts"))
+    ccd_calib(fnames=str(tmp_path / "raw"), astro_scrappy=(0, 3), **frames)
+
+    assert sorted(calls) == fnames
+    assert len(_calibrated(tmp_path)) == 4
+
+
+def test_ccd_calib_checks_setup_once(tmp_path, frames, monkeypatch):
+    # The checks are recorded in a file since they could be made by workers
+    checks = tmp_path / "checks.txt"
+
+    def check_frame_info(image_info):
+        with open(checks, "a") as f:
+            f.write("%s\n" % image_info["exptime"])
+
+    monkeypatch.setattr(ccd_calib_module, "_check_frame_info", check_frame_info)
+    ccd_calib(fnames=str(tmp_path / "raw"), astro_scrappy=(0, 3), workers=2, **frames)
+
+    assert sorted(checks.read_text().split()) == ["30.0", "60.0"]
+    assert len(_calibrated(tmp_path)) == 4
+
+
+def test_group_by_setup(tmp_path, frames):
+    fnames = sorted(str(fname) for fname in (tmp_path / "raw").glob("*.fts"))
+    with open(tmp_path / "raw" / "broken.fts", "w") as f:
+        f.write("not a FITS file")
+    groups = ccd_calib_module._group_by_setup(
+        fnames + [str(tmp_path / "raw" / "broken.fts")]
+    )
+
+    assert [info and info["exptime"] for info, _ in groups] == [60.0, 30.0, None]
+    assert [[fname for fname, _ in items] for _, items in groups] == [
+        fnames[0::2],
+        fnames[1::2],
+        [str(tmp_path / "raw" / "broken.fts")],
+    ]
+    assert groups[0][1][0][1]["EXPTIME"] == 60.0
+    assert groups[2][1][0][1] is None
+
+
+def test_ccd_calib_stops_on_write_error(tmp_path, frames, monkeypatch):
+    calibrated = []
+    write_errors = []
+    calibrate_one = ccd_calib_module._calibrate_one
+    write_worker = ccd_calib_module._write_worker
+
+    def calibrate_and_wait(fname, hdr=None, write_queue=None):
+        calibrated.append(fname)
+        calibrate_one(fname, hdr, write_queue=write_queue)
+        # Let the writer fail before the next image is calibrated
+        deadline = time.time() + 10
+        while not write_errors[0] and time.time() < deadline:
+            time.sleep(0.01)
+
+    def write_calibrated(fname, cal_image, hdr):
+        raise OSError("disk full")
+
+    def record_errors(write_queue, errors):
+        write_errors.append(errors)
+        write_worker(write_queue, errors)
+
+    monkeypatch.setattr(ccd_calib_module, "_calibrate_one", calibrate_and_wait)
+    monkeypatch.setattr(ccd_calib_module, "_write_calibrated", write_calibrated)
+    monkeypatch.setattr(ccd_calib_module, "_write_worker", record_errors)
+    with pytest.raises(OSError, match="disk full"):
+        ccd_calib(fnames=str(tmp_path / "raw"), astro_scrappy=(0, 3), **frames)
+
+    assert len(calibrated) == 1
+    assert not _calib_state
+
+
+def test_load_master_cache(tmp_path, frames):
+    dark, info = _load_master(frames["dark_frame"], cache=True)
+    assert dark.dtype == np.float32
+    assert info["frametyp"] == "Dark Frame"
+    assert info["exptime"] == 60.0
+    assert os.path.exists(tmp_path / "master-dark.f32.npy")
+    assert os.path.exists(tmp_path / "master-dark.json")
+
+    # Later loads memory-map the cached frame
+    cached, cached_info = _load_master(frames["dark_frame"], cache=True)
+    assert isinstance(cached, np.memmap)
+    assert cached_info == info
+    np.testing.assert_array_equal(cached, dark)
+
+    # The cache is ignored once the master frame is newer
+    mtime = os.path.getmtime(tmp_path / "master-dark.f32.npy")
+    os.utime(frames["dark_frame"], (mtime + 10, mtime + 10))
+    reloaded, _ = _load_master(frames["dark_frame"], cache=True)
+    assert not isinstance(reloaded, np.memmap)
+
+
+def test_ccd_calib_cache_masters(tmp_path, frames):
+    ccd_calib(
+        fnames=str(tmp_path / "raw"), astro_scrappy=(0, 3), cache_masters=True, **frames
+    )
+    for name in ("bias", "dark", "flat"):
+        assert os.path.exists(tmp_path / f"master-{name}.f32.npy")
+    uncached = _calibrated(tmp_path)
+
+    ccd_calib(
+        fnames=str(tmp_path / "raw"), astro_scrappy=(0, 3), cache_masters=True, **frames
+    )
+    for a, b in zip(uncached, _calibrated(tmp_path)):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_hget():
+    hdr = fits.Header()
+    hdr["XBIN"] = 2
+    hdr["EXPTIME"] = 30.0
+    hdr["EXPOSURE"] = 60.0
+
+    assert _hget(hdr, "XBINNING", "XBIN") == 2
+    # The first keyword present wins
+    assert _hget(hdr, "EXPTIME", "EXPOSURE") == 30.0
+    assert _hget(hdr, "FILTER", default="") == ""
+    assert _hget(hdr, "PEDESTAL", default=None) is None
+    with pytest.raises(KeyError):
+        _hget(hdr, "READOUTM", "READOUT")
+
+
+def test_ccd_calib_bad_columns(tmp_path, frames):
+    ccd_calib(fnames=str(tmp_path / "raw"), astro_scrappy=(0, 3), **frames)
+    good = _calibrated(tmp_path)
+    # Blank entries are ignored and edge columns use their only neighbour
+    ccd_calib(
+        fnames=str(tmp_path / "raw"),
+        astro_scrappy=(0, 3),
+        bad_columns="0, 5,,47",
+        **frames,
+    )
+    fixed = _calibrated(tmp_path)
+
+    for a, b in zip(good, fixed):
+        a = a.astype(np.float64)
+        np.testing.assert_array_equal(b[:, 0], a[:, 1])
+        np.testing.assert_array_equal(
+            b[:, 5], ((a[:, 4] + a[:, 6]) / 2).astype(np.uint16)
+        )
+        np.testing.assert_array_equal(b[:, 47], a[:, 46])
+        np.testing.assert_array_equal(b[:, 6:47], a[:, 6:47])
+
+
+@pytest.mark.parametrize("extension", [False, True])
+def test_read_fits_backends(tmp_path, monkeypatch, extension):
+    pytest.importorskip("fitsio")
+    fname = str(tmp_path / "image.fts")
+    data = np.random.default_rng(0).integers(0, 65535, (64, 48), dtype=np.uint16)
+    hdr = fits.Header()
+    hdr["IMAGETYP"] = "Light Frame"
+    hdr["READOUTM"] = "highgain"
+    hdr["EXPTIME"] = 30.0
+    hdr["XBINNING"] = 2
+    hdr["YBINNING"] = 2
+    hdr["GAIN"] = 1.5
+    hdr["FILTER"] = "R"
+    hdr["PEDESTAL"] = 1000
+    if extension:
+        # Compressed images are stored in the first extension
+        fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, hdr)]).writeto(fname)
+    else:
+        fits.writeto(fname, data, hdr)
+
+    fitsio_data, fitsio_hdr = ccd_calib_module._read_fits(fname)
+    monkeypatch.setattr(ccd_calib_module, "fitsio", None)
+    astropy_data, astropy_hdr = ccd_calib_module._read_fits(fname)
+
+    assert fitsio_data.dtype == astropy_data.dtype == np.float32
+    np.testing.assert_array_equal(fitsio_data, data)
+    np.testing.assert_array_equal(astropy_data, data)
+    assert ccd_calib_module._frame_info(fitsio_hdr) == ccd_calib_module._frame_info(
+        astropy_hdr
+    )
+
+
+@pytest.fixture
+def calib_frames():
+    """Float32 frames with a size that is not a multiple of the strip size."""
+    rng = np.random.default_rng(0)
+    shape = (300, 301)
+    assert (shape[0] * shape[1]) % ccd_calib_module._TILE_PIXELS != 0
+    image = rng.normal(1500, 200, shape).astype(np.float32)
+    # Values that fall outside of the uint16 range once calibrated
+    image[0, :10] = -500
+    image[-1, -10:] = 70000
+    return dict(
+        image=image,
+        bias=rng.normal(100, 5, shape).astype(np.float32),
+        dark=rng.normal(50, 5, shape).astype(np.float32),
+        flat=rng.normal(1, 0.05, shape).astype(np.float32),
+    )
+
+
+@pytest.mark.parametrize("with_flat", [False, True])
+@pytest.mark.parametrize("dtype", [np.float32, np.uint16])
+def test_calibrate_image_numpy(calib_frames, monkeypatch, with_flat, dtype):
+    monkeypatch.setattr(ccd_calib_module, "numba", None)
+    image, bias, dark = (calib_frames[key] for key in ("image", "bias", "dark"))
+    flat = calib_frames["flat"] if with_flat else None
+
+    expected = image - dark - bias
+    if with_flat:
+        expected /= flat
+    expected = np.floor(expected) + 1000
+    if dtype == np.uint16:
+        expected = np.clip(expected, 0, 65535).astype(np.uint16)
+
+    out = np.empty(image.shape, dtype=dtype)
+    result = ccd_calib_module._calibrate_image(image, out, 1000, bias, dark, flat)
+    assert result is out
+    np.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.parametrize("with_flat", [False, True])
+@pytest.mark.parametrize("dtype", [np.float32, np.uint16])
+def test_calibrate_image_jit(calib_frames, monkeypatch, with_flat, dtype):
+    if ccd_calib_module.numba is None:
+        pytest.skip("numba is not installed")
+    image, bias, dark = (calib_frames[key] for key in ("image", "bias", "dark"))
+    flat = calib_frames["flat"] if with_flat else None
+
+    jit = np.empty(image.shape, dtype=dtype)
+    ccd_calib_module._calibrate_image(image, jit, 1000, bias, dark, flat)
+    monkeypatch.setattr(ccd_calib_module, "numba", None)
+    numpy = np.empty(image.shape, dtype=dtype)
+    ccd_calib_module._calibrate_image(image, numpy, 1000, bias, dark, flat)
+
+    np.testing.assert_array_equal(jit, numpy)
+
+
 if __name__ == "__main__":
     test_ccd_calib(os.path.join(os.getcwd(), "tmp_dir"))
     print("test passed, removing temp directory...")
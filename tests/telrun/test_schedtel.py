@@ -1,9 +1,60 @@
+import concurrent.futures
+import copy
+import json
 import logging
+import os
+import shutil
+import threading
 from pathlib import Path
 
+import astroplan
+import numpy as np
 import pytest
+from astroplan.target import get_skycoord
+from astropy import coordinates as coord
+from astropy import table
+from astropy import time as astrotime
+from astropy import units as u
+from astroquery import mpc
 
-from pyscope.telrun import plot_schedule_gantt, plot_schedule_sky, schedtel
+from pyscope.telrun import plot_schedule_gantt, plot_schedule_sky, sch, schedtel
+from pyscope.telrun.schedtel import (
+    _CachedMoonSeparationConstraint,
+    _CachedTransitioner,
+    _load_observatory,
+    _read_observatory,
+    _ShortCircuitConstraints,
+    _sun_events,
+    _write_table,
+)
+
+OBSERVATORY = "./tests/bin/simulator_observatory.cfg"
+
+# Targets with explicit coordinates, so that no name has to be resolved
+SCH_FILES = {
+    "aaa.sch": """title "Test A"
+observer test@example.com
+code aaa
+source "A" ra 06:00:00 dec +40:00:00 exposure 10 filter R,G nexp 2
+source "B" ra 07:00:00 dec +35:00:00 exposure 10 filter R nexp 2
+source "C" ra 08:00:00 dec +45:00:00 exposure 10 filter G nexp 2
+""",
+    "bbb.sch": """title "Test B"
+observer test@example.com
+code bbb
+source "D" ra 05:00:00 dec +30:00:00 exposure 10 filter R nexp 2
+source "E" ra 09:00:00 dec +50:00:00 exposure 10 filter B nexp 2
+source "F" ra 12:00:00 dec -85:00:00 exposure 10 filter R nexp 1
+""",
+}
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    for fname, text in SCH_FILES.items():
+        (tmp_path / fname).write_text(text)
+    (tmp_path / "test.cat").write_text("\n".join(SCH_FILES) + "\n")
+    return str(tmp_path / "test.cat")
 
 
 def test_schedtel(tmp_path):
@@ -27,5 +78,401 @@ def test_schedtel(tmp_path):
     fig.savefig(str(tmp_path) + "test_schedtel_sky.png", bbox_inches="tight")
 
 
+def test_plot_schedule_gantt_from_ecsv(tmp_path, catalog):
+    fname = str(tmp_path / "schedule.ecsv")
+    schedtel(
+        catalog=catalog,
+        observatory=OBSERVATORY,
+        date="2024-01-15",
+        filename=fname,
+        yes=True,
+    )
+
+    # Target F never rises, so the time columns are read back masked
+    schedule_table = table.Table.read(fname, format="ascii.ecsv")
+    assert np.any(schedule_table["status"] != "S")
+
+    fig, ax = plot_schedule_gantt(fname, OBSERVATORY)
+    fig.savefig(str(tmp_path / "gantt.png"))
+    assert len(ax.collections) == 2
+
+
+def test_cached_transitioner_uses_cache(tmp_path, catalog, monkeypatch):
+    blocks = sch.read(str(tmp_path / "aaa.sch"))
+    observer = astroplan.Observer(
+        location=coord.EarthLocation(lon=33.7 * u.deg, lat=42.4 * u.deg)
+    )
+    start_time = astrotime.Time("2024-01-16T00:00:00")
+    expected = astroplan.Transitioner(
+        0.5 * u.deg / u.second, {"filter": {"default": 5 * u.second}}
+    )(blocks[0], blocks[-1], start_time, observer)
+
+    transitioner = _CachedTransitioner(
+        blocks, 0.5 * u.deg / u.second, {"filter": {"default": 5 * u.second}}
+    )
+
+    # The scheduler passes shallow copies of the blocks to the transitioner
+    def fallback(*args, **kwargs):
+        raise AssertionError("cached transition not used")
+
+    monkeypatch.setattr(astroplan.Transitioner, "__call__", fallback)
+    for _ in range(2):
+        transition = transitioner(
+            copy.copy(blocks[0]), copy.copy(blocks[-1]), start_time, observer
+        )
+        assert transition.components.keys() == expected.components.keys()
+        assert u.allclose(transition.duration, expected.duration, rtol=1e-3)
+    assert list(transitioner._components) == [(0, len(blocks) - 1)]
+
+
+def test_write_table_fits(tmp_path):
+    tbl = table.Table(
+        {
+            "name": ["A", "B"],
+            "exposure": [10.0, 20.0],
+            "constraints": np.array([[1, 2], None], dtype=object),
+        }
+    )
+    fname = str(tmp_path / "schedule.fits")
+    _write_table(tbl, fname, "fits")
+
+    written = table.Table.read(fname)
+    assert list(written["name"]) == ["A", "B"]
+    assert list(written["exposure"]) == [10.0, 20.0]
+    assert list(written["constraints"]) == ["[1, 2]", "null"]
+    # The table that was passed in keeps its object column
+    assert tbl["constraints"].dtype == object
+
+
+def test_schedtel_output_format(tmp_path, catalog, monkeypatch):
+    # An extension that does not match the format is replaced
+    schedtel(
+        catalog=str(tmp_path / "aaa.sch"),
+        observatory=OBSERVATORY,
+        date="2024-01-15",
+        filename=str(tmp_path / "schedule.ecsv"),
+        output_format="fits",
+        yes=True,
+    )
+    assert (tmp_path / "schedule.fits").exists()
+    assert not (tmp_path / "schedule.ecsv").exists()
+    table.Table.read(str(tmp_path / "schedule.fits"))
+
+    # The file name is kept as is for the default format
+    schedtel(
+        catalog=str(tmp_path / "aaa.sch"),
+        observatory=OBSERVATORY,
+        date="2024-01-15",
+        filename=str(tmp_path / "tonight"),
+        yes=True,
+    )
+    assert (tmp_path / "tonight").exists()
+    assert not (tmp_path / "tonight.ecsv").exists()
+    table.Table.read(str(tmp_path / "tonight"), format="ascii.ecsv")
+
+    # telrun only reads .ecsv files
+    monkeypatch.setenv("TELRUN_EXECUTE", str(tmp_path))
+    schedtel(
+        catalog=str(tmp_path / "aaa.sch"),
+        observatory=OBSERVATORY,
+        date="2024-01-15",
+        output_format="fits",
+        telrun=True,
+        yes=True,
+    )
+    written = list((tmp_path / "schedules" / "execute").iterdir())
+    assert len(written) == 1
+    assert written[0].name.startswith("telrun_")
+    assert written[0].suffix == ".ecsv"
+
+
+def test_sun_events():
+    lon, lat = 33.705697, 42.381503
+    t0 = astrotime.Time("2024-01-15T10:00:00")
+    events = _sun_events(lon, lat, t0.jd)
+
+    observer = astroplan.Observer(
+        location=coord.EarthLocation(lon=lon * u.deg, lat=lat * u.deg)
+    )
+    expected = [
+        observer.sun_set_time(t0, which="next"),
+        observer.twilight_evening_civil(t0, which="next"),
+        observer.twilight_evening_nautical(t0, which="next"),
+        observer.twilight_evening_astronomical(t0, which="next"),
+        observer.twilight_morning_astronomical(t0, which="next"),
+        observer.twilight_morning_nautical(t0, which="next"),
+        observer.twilight_morning_civil(t0, which="next"),
+        observer.sun_rise_time(t0, which="next"),
+    ]
+    for event, time in zip(events, expected):
+        assert abs((event - time).sec) < 60
+
+    # The events of a night are cached
+    assert _sun_events(lon, lat, t0.jd) is events
+
+
+@pytest.fixture
+def night():
+    observer = astroplan.Observer(
+        location=coord.EarthLocation(lon=33.7 * u.deg, lat=42.4 * u.deg)
+    )
+    targets = [
+        astroplan.FixedTarget(coord.SkyCoord(ra * u.deg, dec * u.deg))
+        for ra, dec in [(90, 40), (105, 35), (180, -85), (120, 45)]
+    ]
+    times = astroplan.time_grid_from_range(
+        [astrotime.Time("2024-01-15T10:00"), astrotime.Time("2024-01-16T10:00")],
+        time_resolution=10 * u.minute,
+    )
+    return observer, targets, times
+
+
+class _RecordTimes(astroplan.Constraint):
+    def __init__(self):
+        self.times = []
+
+    def compute_constraint(self, times, observer, targets):
+        self.times.append(len(times))
+        return np.ones(np.broadcast_shapes(times.shape, targets.shape))
+
+
+def test_short_circuit_constraints(night):
+    observer, targets, times = night
+    constraints = [
+        astroplan.AltitudeConstraint(min=30 * u.deg),
+        astroplan.AtNightConstraint(max_solar_altitude=-12 * u.deg),
+        astroplan.MoonSeparationConstraint(min=30 * u.deg),
+        astroplan.AirmassConstraint(max=3, boolean_constraint=False),
+    ]
+    expected = np.prod(
+        [c(observer, targets, times, grid_times_targets=True) for c in constraints],
+        axis=0,
+    )
+    result = _ShortCircuitConstraints(constraints)(
+        observer, targets, times, grid_times_targets=True
+    )
+    np.testing.assert_allclose(result, expected)
+
+    # Later constraints are only evaluated while some target is observable
+    record = _RecordTimes()
+    _ShortCircuitConstraints(constraints[:2] + [record])(
+        observer, targets, times, grid_times_targets=True
+    )
+    observable = np.prod(
+        [c(observer, targets, times, grid_times_targets=True) for c in constraints[:2]],
+        axis=0,
+    )
+    assert record.times == [np.count_nonzero(np.any(observable, axis=0))]
+    assert 0 < record.times[0] < len(times)
+
+
+CUSTOM_SCHEDULER = """import json
+import os
+
+import astroplan
+
+
+# schedtel requires astroplan.Scheduler to be a direct base
+class RecordingScheduler(astroplan.PriorityScheduler, astroplan.Scheduler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        with open(os.path.join(os.path.dirname(__file__), "constraints.json"), "w") as f:
+            json.dump([type(c).__name__ for c in self.constraints], f)
+"""
+
+
+def test_schedtel_custom_scheduler_constraints(tmp_path, catalog):
+    (tmp_path / "recording.py").write_text(CUSTOM_SCHEDULER)
+    schedule = schedtel(
+        catalog=str(tmp_path / "aaa.sch"),
+        observatory=OBSERVATORY,
+        date="2024-01-15",
+        scheduler=(str(tmp_path / "recording.py"), "RecordingScheduler"),
+        filename=str(tmp_path / "schedule.ecsv"),
+        yes=True,
+    )
+
+    # Custom schedulers get the global constraints rather than their wrapper
+    assert json.loads((tmp_path / "constraints.json").read_text()) == [
+        "AltitudeConstraint",
+        "AtNightConstraint",
+        "_CachedMoonSeparationConstraint",
+        "AirmassConstraint",
+    ]
+    assert np.count_nonzero(schedule["status"] == "S") > 0
+
+
+def test_cached_moon_separation_constraint(night, monkeypatch):
+    observer, targets, times = night
+    constraint = _CachedMoonSeparationConstraint(times, min=30 * u.deg)
+    expected = astroplan.MoonSeparationConstraint(min=30 * u.deg)(
+        observer, targets, times, grid_times_targets=True
+    )
+    result = constraint(observer, targets, times, grid_times_targets=True)
+    np.testing.assert_array_equal(result, expected)
+    assert constraint._computed.all()
+
+    # Once every time of the grid is known, the Moon is not computed again
+    def get_body(*args, **kwargs):
+        raise AssertionError("Moon computed again")
+
+    monkeypatch.setattr(coord, "get_body", get_body)
+    result = constraint.compute_constraint(
+        times[10:20], observer, get_skycoord(targets)[:, None]
+    )
+    np.testing.assert_array_equal(result, expected[:, 10:20])
+
+
+def test_schedtel_astrom_interp_minutes(tmp_path, catalog, monkeypatch):
+    # Record which astrometry computation is active while the altitudes are computed
+    altaz = astroplan.Observer.altaz
+    active = []
+
+    def record_altaz(self, *args, **kwargs):
+        active.append(type(coord.erfa_astrom.erfa_astrom.get()))
+        return altaz(self, *args, **kwargs)
+
+    monkeypatch.setattr(astroplan.Observer, "altaz", record_altaz)
+
+    tables = []
+    for minutes in (0, 5):
+        active.clear()
+        tables.append(
+            schedtel(
+                catalog=str(tmp_path / "aaa.sch"),
+                observatory=OBSERVATORY,
+                date="2024-01-15",
+                filename=str(tmp_path / f"schedule_{minutes}.ecsv"),
+                astrom_interp_minutes=minutes,
+                yes=True,
+            )
+        )
+        used_interpolator = coord.erfa_astrom.ErfaAstromInterpolator in active
+        assert used_interpolator == bool(minutes)
+
+    # Interpolating the astrometric parameters does not change the schedule by
+    # more than the 5 s time resolution
+    exact, interpolated = [t[t["status"] == "S"] for t in tables]
+    assert len(exact) == len(interpolated) > 0
+    assert list(exact["name"]) == list(interpolated["name"])
+    assert np.all(np.abs((exact["start_time"] - interpolated["start_time"]).sec) <= 5)
+
+
+def test_schedtel_update_ephemeris(tmp_path, monkeypatch):
+    (tmp_path / "ccc.sch").write_text(
+        """title "Test C"
+observer test@example.com
+code ccc
+source "G" ra 06:00:00 dec +40:00:00 nonsidereal true pm_ra_cosdec 1 pm_dec 1 exposure 10 filter R nexp 2
+source "H" ra 07:00:00 dec +35:00:00 nonsidereal true pm_ra_cosdec 1 pm_dec 1 exposure 10 filter G nexp 2
+"""
+    )
+    (tmp_path / "test.cat").write_text("ccc.sch\n")
+
+    def get_ephemeris(*args, **kwargs):
+        raise ConnectionError("MPC is unavailable")
+
+    # The targets cross RA 0h while moving north by 0.01 deg during each block
+    real_get_body = coord.get_body
+    threads = []
+
+    def get_body(name, times, *args, **kwargs):
+        if name not in ("G", "H"):
+            return real_get_body(name, times, *args, **kwargs)
+        threads.append(threading.current_thread().name)
+        return coord.SkyCoord(
+            ra=[359.99, 0, 0.01] * u.deg,
+            dec=[10, 10.005, 10.01] * u.deg,
+            obstime=times,
+        )
+
+    monkeypatch.setattr(mpc.MPC, "get_ephemeris", get_ephemeris)
+    monkeypatch.setattr(coord, "get_body", get_body)
+    schedule = schedtel(
+        catalog=str(tmp_path / "test.cat"),
+        observatory=OBSERVATORY,
+        date="2024-01-15",
+        filename=str(tmp_path / "schedule.ecsv"),
+        yes=True,
+    )
+
+    # The ephemerides of every block are updated by the thread pool
+    scheduled = schedule[schedule["status"] == "S"]
+    assert len(set(scheduled["name"])) == 2
+    assert len(threads) == len(scheduled)
+    assert all(name.startswith("ThreadPoolExecutor") for name in threads)
+
+    dt = (scheduled["end_time"] - scheduled["start_time"]).sec + 1200
+    target = scheduled["target"]
+    np.testing.assert_allclose(target.ra.wrap_at(180 * u.deg).deg, 0, atol=1e-8)
+    np.testing.assert_allclose(target.dec.deg, 10.005)
+    np.testing.assert_allclose(
+        scheduled["pm_ra_cosdec"],
+        0.02 * 3600 * np.cos(np.radians(10.005)) / dt * 3600,
+        rtol=1e-6,
+    )
+    np.testing.assert_allclose(scheduled["pm_dec"], 0.01 * 3600 / dt * 3600, rtol=1e-6)
+
+
+def test_schedtel_reads_catalog_in_processes(tmp_path, monkeypatch):
+    codes = [f"c{i:02d}" for i in range(8)]
+    for i, code in enumerate(codes):
+        (tmp_path / f"{code}.sch").write_text(
+            f"""title "Test {code}"
+observer test@example.com
+code {code}
+source "{code}" ra {5 + i % 4}:00:00 dec +40:00:00 exposure 10 filter R nexp 1
+"""
+        )
+    (tmp_path / "test.cat").write_text(
+        "\n".join(f"{code}.sch" for code in codes) + "\n"
+    )
+
+    contexts = []
+
+    class RecordingExecutor(concurrent.futures.ProcessPoolExecutor):
+        def __init__(self, *args, mp_context=None, **kwargs):
+            contexts.append(mp_context)
+            super().__init__(*args, mp_context=mp_context, **kwargs)
+
+    # More than one worker is used even on a single CPU
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", RecordingExecutor)
+    schedule = schedtel(
+        catalog=str(tmp_path / "test.cat"),
+        observatory=OBSERVATORY,
+        date="2024-01-15",
+        filename=str(tmp_path / "schedule.ecsv"),
+        yes=True,
+    )
+
+    assert [context.get_start_method() for context in contexts] == ["spawn"]
+    # Every file is read, whether or not its block could be scheduled
+    assert set(np.ma.compressed(schedule["code"])) == set(codes)
+
+
+def test_load_observatory(tmp_path):
+    path = tmp_path / "observatory.cfg"
+    shutil.copy(OBSERVATORY, path)
+
+    first = _load_observatory(str(path))
+    second = _load_observatory(str(path))
+    assert first.slew_rate == 0.5 * u.deg / u.second
+    assert first.instrument_reconfig_times == {}
+    # Every call gets its own observer and reconfiguration times
+    assert first.observer is not second.observer
+    first.instrument_reconfig_times["filter"] = {}
+    assert second.instrument_reconfig_times == {}
+    hits = _read_observatory.cache_info().hits
+    assert hits > 0
+
+    # The config is read again once the file is modified
+    path.write_text(path.read_text().replace("slew_rate = 0.5", "slew_rate = 2"))
+    mtime = os.stat(path).st_mtime_ns + 10**9
+    os.utime(path, ns=(mtime, mtime))
+    assert _load_observatory(str(path)).slew_rate == 2 * u.deg / u.second
+    assert _read_observatory.cache_info().hits == hits
+
+
 if __name__ == "__main__":
     test_schedtel("./tests/bin/")
@@ -0,0 +1,13 @@
+from pyscope.utils import _timezone_at
+from pyscope.utils._timezone import _timezone_finder
+
+
+def test_timezone_at():
+    assert _timezone_at(-91.53, 41.66) == "America/Chicago"
+    assert _timezone_at(16.37, 48.21) == "Europe/Vienna"
+
+    # The finder is only created once and repeated sites are not looked up again
+    hits = _timezone_at.cache_info().hits
+    assert _timezone_at(-91.53, 41.66) == "America/Chicago"
+    assert _timezone_at.cache_info().hits == hits + 1
+    assert _timezone_finder.cache_info().currsize == 1
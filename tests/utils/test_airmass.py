@@ -1,7 +1,12 @@
+import importlib
+
 import numpy as np
+import pytest
 
 from pyscope.utils import airmass
 
+airmass_module = importlib.import_module("pyscope.utils.airmass")
+
 
 def test_airmass():
     deg = np.pi / 180
@@ -11,3 +16,19 @@ def test_airmass():
     assert np.round(airmass(30 * deg), 2) == 1.99
     assert np.round(airmass(15 * deg), 2) == 3.81
     assert np.round(airmass(0 * deg), 2) == 38.75
+
+
+def test_airmass_shapes():
+    alt = np.linspace(5, 90, 12).reshape(3, 4) * np.pi / 180
+    result = airmass(alt)
+    assert result.shape == (3, 4)
+    assert np.ndim(airmass(alt[0, 0])) == 0
+    np.testing.assert_allclose(result.ravel(), [airmass(a) for a in alt.ravel()])
+
+
+@pytest.mark.skipif(airmass_module.numba is None, reason="numba is not installed")
+def test_airmass_jit():
+    deg = np.pi / 180
+    alt = np.linspace(0, 90, 181) * deg
+    expected = 1 / np.sin((alt / deg + 244 / (165 + 47 * (alt / deg) ** 1.1)) * deg)
+    np.testing.assert_allclose(airmass_module._airmass_jit(alt), expected, rtol=1e-12)